@@ -248,10 +248,17 @@ def analyse(config, prog, argv):
         # The lambda compares two patches of an equivalence class and chooses
         # the one with the later release version
         if mbox:
-            representatives = patch_groups.get_representative_system(
-                lambda x, y:
-                    repo.get_commit(x).author.date >
-                    repo.get_commit(y).author.date)
+            # Mails are ranked by their author date. Ranks are persisted with
+            # the result, so only mails that are new to the result need to be
+            # loaded.
+            unranked = patch_groups.get_unranked()
+            log.info('  Ranking %d mails' % len(unranked))
+            for message_id in unranked:
+                patch_groups.set_rank(
+                    message_id,
+                    repo.get_commit(message_id).author.date.timestamp())
+            patch_groups.to_file(f_patch_groups)
+            representatives = patch_groups.get_representatives()
         else:
             representatives = patch_groups.get_representative_system(
                 lambda x, y: config.psd.is_stack_version_greater(
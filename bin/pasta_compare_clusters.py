@@ -9,63 +9,207 @@ Author:
 This work is licensed under the terms of the GNU GPL, version 2.  See
 the COPYING file in the top-level directory.
 """
+import glob
+import numpy as np
 import os
 import sys
 
 from logging import getLogger
+from multiprocessing import Pool, cpu_count
 from sklearn import metrics
-from itertools import combinations
+from collections import Counter
+from itertools import chain
+from tqdm import tqdm
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from pypasta import *
 
 log = getLogger(__name__[-15:])
 
+BATCH_METRICS = ['homo', 'comp', 'vm', 'ar', 'mi', 'ami', 'nmi', 'pur', 'fm',
+                 'precision', 'recall', 'fmeasure']
+
+# Encoded ground truth for batch comparisons. Shared with forked workers.
+_ground_truth = None
+
+
+def contingency_table(truth, pred):
+    """
+    Returns the contingency table of two label arrays: a Counter that maps
+    (ground truth id, prediction id) to the number of keys that both classes
+    have in common.
+    """
+    return Counter(zip(truth.tolist(), pred.tolist()))
+
+
+def pairs(n):
+    return n * (n - 1) // 2
+
+
+def pair_confusion(table):
+    """
+    Returns the number of true positive, true negative, false positive and
+    false negative pairs of keys. Instead of comparing all pairs of keys, the
+    numbers are derived from the contingency table.
+    """
+    truth_sizes = Counter()
+    pred_sizes = Counter()
+    for (truth, pred), n in table.items():
+        truth_sizes[truth] += n
+        pred_sizes[pred] += n
+
+    comparisons = pairs(sum(truth_sizes.values()))
+    true_positives = sum(map(pairs, table.values()))
+    false_negatives = sum(map(pairs, truth_sizes.values())) - true_positives
+    false_positives = sum(map(pairs, pred_sizes.values())) - true_positives
+    true_negatives = comparisons - true_positives - false_negatives - \
+                     false_positives
+
+    return true_positives, true_negatives, false_positives, false_negatives
+
+
+def purity(table):
+    hits = dict()
+    for (truth, _), n in table.items():
+        if n > hits.get(truth, 0):
+            hits[truth] = n
+
+    return sum(hits.values()) / sum(table.values())
 
-def prec_rec(ground_truth, prediction):
-    ground_truth_keys = ground_truth.get_keys()
-    prediction_keys = prediction.get_keys()
 
-    combs = list(combinations(ground_truth_keys | prediction_keys, 2))
-    false_positives = 0
-    true_positives = 0
-    false_negatives = 0
-    true_negatives = 0
-
-    for source, dest in combs:
-        truth = ground_truth.is_related(source, dest)
-        pred = prediction.is_related(source, dest)
-
-        if (truth, pred) == (True, True):
-            true_positives += 1
-        elif (truth, pred) == (False, False):
-            true_negatives += 1
-        elif (truth, pred) == (False, True):
-            false_positives += 1
-        elif (truth, pred) == (True, False):
-            false_negatives += 1
+def precision_recall(true_positives, false_positives, false_negatives):
+    precision = recall = fmeasure = 0.0
+
+    if true_positives:
+        precision = true_positives / (true_positives + false_positives)
+        recall = true_positives / (true_positives + false_negatives)
+        fmeasure = 2 * precision * recall / (precision + recall)
+
+    return precision, recall, fmeasure
+
+
+def prec_rec(table):
+    true_positives, true_negatives, false_positives, false_negatives = \
+        pair_confusion(table)
 
     log.info('')
-    log.info('Comparisons: %d' % len(combs))
+    log.info('Comparisons: %d' % pairs(sum(table.values())))
     log.info('True Positives: %d' % true_positives)
     log.info('True Negatives: %d' % true_negatives)
     log.info('False Positives: %d' % false_positives)
     log.info('False Negatives: %d' % false_negatives)
 
-    precision = true_positives / (true_positives + false_positives)
-    recall = true_positives / (true_positives + false_negatives)
-    fmeasure = 2 * precision * recall / (precision + recall)
+    precision, recall, fmeasure = \
+        precision_recall(true_positives, false_positives, false_negatives)
 
     log.info('  Precision: %f' % precision)
     log.info('  Recall: %f' % recall)
     log.info('  F-Measure: %f' % fmeasure)
 
 
+def encode_ground_truth(ground_truth):
+    """
+    Encodes the ground truth as a mapping of keys to array indices and an
+    integer array that contains the class id of each key.
+    """
+    return ground_truth.get_key_index(), ground_truth.get_labels(), \
+           len(ground_truth.classes)
+
+
+def align_prediction(ground_truth, prediction):
+    """
+    Returns the label arrays of an encoded ground truth and a prediction over
+    the union of their keys. Keys that are missing in one of both clusterings
+    become single-element classes.
+    """
+    key_index, truth, num_truth_classes = ground_truth
+
+    extra = sorted(prediction.get_keys() - key_index.keys())
+    truth = np.concatenate((truth,
+                            np.arange(num_truth_classes,
+                                      num_truth_classes + len(extra))))
+    pred = prediction.get_labels(chain(key_index, extra))
+
+    return truth, pred
+
+
+def score(truth, pred):
+    table = contingency_table(truth, pred)
+    true_positives, _, false_positives, false_negatives = pair_confusion(table)
+
+    homo, comp, vm = metrics.homogeneity_completeness_v_measure(truth, pred)
+
+    return [homo, comp, vm,
+            metrics.adjusted_rand_score(truth, pred),
+            metrics.mutual_info_score(truth, pred),
+            metrics.adjusted_mutual_info_score(truth, pred),
+            metrics.normalized_mutual_info_score(truth, pred),
+            purity(table),
+            metrics.fowlkes_mallows_score(truth, pred)] + \
+           list(precision_recall(true_positives, false_positives,
+                                 false_negatives))
+
+
+def _score_prediction(filename):
+    prediction = Cluster.from_file(filename, must_exist=True)
+    truth, pred = align_prediction(_ground_truth, prediction)
+    return filename, score(truth, pred)
+
+
+# Sidecar files of cluster results that are no predictions
+SKIP_SUFFIXES = (Cluster.RANKS_SUFFIX, '.lock', '.tmp')
+
+
+def expand_predictions(patterns):
+    """
+    Expands directories (recursively) and glob patterns to a sorted list of
+    prediction files. Sidecar files, like ranks and lock files, are skipped.
+    """
+    predictions = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                predictions |= {os.path.join(root, x) for x in files}
+        else:
+            predictions |= {x for x in glob.glob(pattern, recursive=True)
+                            if os.path.isfile(x)}
+
+    return sorted([x for x in predictions if not x.endswith(SKIP_SUFFIXES)])
+
+
+def compare_batch(f_ground_truth, patterns, f_result):
+    predictions = expand_predictions(patterns)
+    if not predictions:
+        log.error('No predictions found')
+        return -1
+
+    global _ground_truth
+    ground_truth = Cluster.from_file(f_ground_truth, must_exist=True)
+    _ground_truth = encode_ground_truth(ground_truth)
+    del ground_truth
+
+    log.info('Comparing %d predictions against %s' %
+             (len(predictions), f_ground_truth))
+    with Pool(cpu_count()) as p:
+        results = list(tqdm(p.imap(_score_prediction, predictions),
+                            total=len(predictions)))
+    _ground_truth = None
+
+    f = open(f_result, 'w') if f_result else sys.stdout
+    f.write(','.join(['prediction'] + BATCH_METRICS) + '\n')
+    for filename, values in results:
+        f.write(','.join([filename] + ['%0.6f' % x for x in values]) + '\n')
+    if f_result:
+        f.close()
+
+    return 0
+
+
 def compare_clusters(prog, argv):
     parser = argparse.ArgumentParser(prog=prog,
                                      description='Compare Equivalence Classes')
-    parser.add_argument('classes', metavar='eqclass', type=str, nargs=2,
-                        help='Ground Truth / Prediction')
+    parser.add_argument('classes', metavar='eqclass', type=str, nargs='+',
+                        help='Ground Truth / Prediction(s)')
     parser.add_argument('-ar', action='store_true', default=False,
                         help='Adjusted rand score')
     parser.add_argument('-mi', action='store_true', default=False,
@@ -83,11 +227,23 @@ def compare_clusters(prog, argv):
     parser.add_argument('-remove-identical', action='store_true', default=False,
                         help='Remove identical clusters before comparing')
     parser.add_argument('-f', type=str, help='Write results to filename')
+    parser.add_argument('-batch', action='store_true', default=False,
+                        help='Compare the ground truth against all predictions '
+                             'that match the given directories or glob '
+                             'patterns. Writes all metrics as CSV.')
     parser.add_argument('-test', action='store_true', default=False,
                         help='run tests')
 
     args = parser.parse_args(argv)
 
+    if args.batch:
+        if len(args.classes) < 2 or args.remove_identical or args.test:
+            parser.error('-batch requires a ground truth and at least one '
+                         'prediction, and no -remove-identical or -test')
+        return compare_batch(args.classes[0], args.classes[1:], args.f)
+    elif len(args.classes) != 2 and not args.test:
+        parser.error('exactly one ground truth and one prediction required')
+
     # These are the converted example from:
     # https://nlp.stanford.edu/IR-book/html/htmledition/evaluation-of-clustering-1.html
 
@@ -124,30 +280,24 @@ def compare_clusters(prog, argv):
         ground_truth.optimize()
         prediction.optimize()
 
-    if (args.pr):
-        prec_rec(ground_truth, prediction)
-
     # intermix all keys
     ground_truth_keys = ground_truth.get_keys()
     prediction_keys = prediction.get_keys()
 
-    missing = ground_truth_keys - prediction_keys
-    log.info('%d keys missing in prediction' % len(missing))
-    for key in missing:
-        prediction.insert_single(key)
-
-    missing = prediction_keys - ground_truth_keys
-    log.info('%d keys missing in ground truth' % len(missing))
-    for key in missing:
-        ground_truth.insert_single(key)
+    log.info('%d keys missing in prediction' %
+             len(ground_truth_keys - prediction_keys))
+    log.info('%d keys missing in ground truth' %
+             len(prediction_keys - ground_truth_keys))
 
-    gt = list(sorted(ground_truth.lookup.items()))
-    t = list(sorted(prediction.lookup.items()))
+    keys = sorted(ground_truth_keys | prediction_keys)
+    gt = ground_truth.get_labels(keys)
+    t = prediction.get_labels(keys)
+    table = contingency_table(gt, t)
 
-    gt = [x[1] for x in gt]
-    t = [x[1] for x in t]
+    log.info('Number of equiv classes: %d' % len(np.unique(gt)))
 
-    log.info('Number of equiv classes: %d' % len(ground_truth))
+    if (args.pr):
+        prec_rec(table)
 
     homo, comp, vm = metrics.homogeneity_completeness_v_measure(gt, t)
     log.info("Homogeneity: %0.3f" % homo)
@@ -167,18 +317,8 @@ def compare_clusters(prog, argv):
         nmi = metrics.normalized_mutual_info_score(gt, t)
         log.info("Normalised mutual info score: %0.3f" % nmi)
     if args.pur:
-        elements = len(gt)
-        hits = 0
-        for w in ground_truth:
-            this = 0
-            for element in w:
-                tmp = prediction[element]
-                foo = len(w & tmp)
-                if foo > this:
-                    this = foo
-            hits += this
-        purity = hits / elements
-        log.info('Purity: %0.3f' % purity)
+        purity_score = purity(table)
+        log.info('Purity: %0.3f' % purity_score)
     if args.fm:
         fm = metrics.fowlkes_mallows_score(gt, t)
         log.info("Fowlkes-Mallows score: %0.3f" % fm)
@@ -197,7 +337,7 @@ def compare_clusters(prog, argv):
             if args.ami:
                 f.write("ami: %0.3f\n" % ami)
             if args.pur:
-                f.write("pur: %0.3f\n" % purity)
+                f.write("pur: %0.3f\n" % purity_score)
             if args.fm:
                 f.write("fm: %0.3f\n" % fm)
 
@@ -10,61 +10,89 @@ This work is licensed under the terms of the GNU GPL, version 2. See
 the COPYING file in the top-level directory.
 """
 
+import argparse
 import re
 import datetime
+import numpy as np
 
+from functools import lru_cache
 from logging import getLogger
-from anytree import LevelOrderIter
+from collections import Counter
+from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
 
+from pypasta.Repository.MailMetadata import parse_author
+
+PATCH_SET_REGEX = re.compile(r'[0-9]+/[0-9]+\]')
+
 _config = None
 _log = getLogger(__name__[-15:])
 _repo = None
 _clusters = None
-_statistic = {
-    'too old': set(),
-    'ignored': set(),
-    'error': set(),
-    'foreign response': set(),
-    'patch set': set(),
-    'large cluster': set(),
-    'similar patch': set(),
-    'analyzed patches': set(),
-    'un-ignored patch sets-versions': set(),
-    'ignored patch sets-versions': set(),
-}
+
+
+def new_statistic():
+    return {
+        'too old': set(),
+        'ignored': set(),
+        'error': set(),
+        'foreign response': set(),
+        'patch set': set(),
+        'large cluster': set(),
+        'similar patch': set(),
+        'analyzed patches': set(),
+        'un-ignored patch sets-versions': set(),
+        'ignored patch sets-versions': set(),
+    }
+
+
+_statistic = new_statistic()
 _patches = None
 _analyzed_patches = set()
 _threads = None
+# Memoised authors, author keys and decisions of is_single_patch_ignored.
+# Related patches never cross components, so memos are dropped after each
+# chunk of components, see reset_memos().
+_authors = dict()
+_author_keys = dict()
+_decisions = dict()
 
 
-def write_and_print_statistic():
-    log = getLogger('Statistics')
-    for key, value in _statistic.items():
-        file_name = (datetime.datetime.now().strftime('%Y.%m.%d-%H:%M_') + str(key) + ".out").replace(' ', '_')
-        if type(value) is str:
-            log.info(str(key) + ': ' + str(value))
-        elif type(value) is set:
-            log.info(str(key) + ': ' + str(len(value)))
-            if len(value) < 100000:
-                f = open(file_name, 'w')
-                for i in value:
-                    f.write(str(i) + '\n')
-                f.close()
-        elif type(value) is dict:
-            log.info(str(key) + ': ' + str(len(value)))
-            if len(value) < 100000:
-                f = open(file_name, 'w')
-                for k, v in value.items():
-                    f.write(str(k) + '\t' + str(v) + '\n')
-                f.close()
-        else:
-            log.info(str(key) + ': ' + str(value))
+class StatisticSink:
+    """
+    Streams the classification of patches to a TSV file with one record
+    (patch, category) per line, as soon as partial statistics arrive. Counts
+    of categories are computed incrementally.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, 'w')
+        self.f.write('patch\tcategory\n')
+        self.counts = Counter()
+
+    def write(self, category, patches):
+        self.f.write(''.join(['%s\t%s\n' % (patch, category)
+                              for patch in patches]))
+        self.counts[category] += len(patches)
+
+    def write_statistic(self, statistic):
+        for category, patches in statistic.items():
+            self.write(category, patches)
+
+    def close(self):
+        self.f.close()
+
+        log = getLogger('Statistics')
+        categories = list(new_statistic().keys())
+        categories += [x for x in self.counts if x not in categories]
+        for category in categories:
+            log.info('%s: %d' % (category, self.counts[category]))
+        log.info('Results written to %s' % self.filename)
 
 
 def was_similar_patch_merged(patch):
     global _clusters  # TODO: Muss ich nicht via get_tagged() schauen ob etw gemerged ist?
-    cluster = _clusters.get_cluster(_clusters.get_key_of_element(patch))
+    cluster = _clusters.get_cluster(patch)
     if cluster is None:
         _statistic['error'].add(patch)
     elif len(cluster) > 1:
@@ -74,53 +102,159 @@ def was_similar_patch_merged(patch):
 
 
 def is_part_of_patch_set(patch):
+    if _threads.series:
+        return _threads.series.is_series(patch)
+
     try:
         subject = _repo[patch].mail_subject
     except KeyError:
         return False
-    if type(re.search(r'[0-9]+/[0-9]+\]', subject)) is type(None):
+    if PATCH_SET_REGEX.search(subject) is None:
         return False
     return True
     # TODO check if patch is part of patch set
 
 
 def get_author_of_msg(msg):
-    try:
-        author = _repo[msg].author
-    except KeyError:
-        return None
-    return author.name + ' ' + author.email
+    """
+    Returns the identity of the author of msg: the lowercase address, or the
+    name, if the address is unknown. Both, the metadata table and PatchMails
+    provide the same identity.
+    """
+    if msg in _authors:
+        return _authors[msg]
+
+    metadata = _threads.metadata
+    row = metadata.find(msg) if metadata else None
+    if row is not None:
+        email = metadata.get_emails()[metadata.emails[row]]
+        name = metadata.get_names()[metadata.names[row]]
+    else:
+        try:
+            name, email = parse_author(str(_repo[msg].author_name))
+        except KeyError:
+            name = email = None
 
+    author = email or name or None
+    _authors[msg] = author
+    return author
 
-def patch_has_foreign_response(patch):
-    if len(_threads.get_thread(patch).children) == 0:
-        return False  # If there is no response the check is trivial
 
-    author = get_author_of_msg(patch)
+def get_author_key(msg):
+    """
+    Returns an integer key of the author of msg, or -1 if it is unknown.
+    Equal authors have equal keys.
+    """
+    author = get_author_of_msg(msg)
     if author is None:
+        return -1
+    return _author_keys.setdefault(author, len(_author_keys))
+
+
+class Thread:
+    """
+    A thread, built once for all patches that belong to it. Author keys of
+    all mails of the thread are precomputed, and so is the set of known
+    authors that the foreign-response rule checks against.
+    """
+    def __init__(self, root):
+        self.mails = list()
+        self.root_children = list()
+        for mail, depth, _ in _threads.walk(root):
+            self.mails.append(mail)
+            if depth == 1:
+                self.root_children.append(mail)
+        self.authors = np.array([get_author_key(mail) for mail in self.mails],
+                                dtype=np.int64)
+        self.keys = dict(zip(self.mails, self.authors.tolist()))
+
+        # Known authors of the thread. If there is no response, the
+        # foreign-response rule is trivial.
+        self.known = set()
+        if len(self.mails) > 1:
+            self.known = set(self.authors[self.authors != -1].tolist())
+
+    def get_author_key(self, mail):
+        key = self.keys.get(mail)
+        if key is None:
+            key = get_author_key(mail)
+        return key
+
+    def has_foreign_response(self, author):
+        # Mails of unknown authors are skipped
+        return len(self.known - {author}) > 0
+
+
+@lru_cache(maxsize=1024)
+def get_thread(root):
+    return Thread(root)
+
+
+@lru_cache(maxsize=None)
+def get_root(patch):
+    return _threads.get_parent(patch)
+
+
+def reset_memos():
+    """
+    Drops all memoised lookups. Cached threads hold author keys, so they are
+    dropped together with the keys.
+    """
+    _authors.clear()
+    _author_keys.clear()
+    _decisions.clear()
+    get_thread.cache_clear()
+    get_root.cache_clear()
+
+
+def get_thread_of_patch(patch):
+    return get_thread(get_root(patch))
+
+
+def patch_has_foreign_response(patch, thread=None):
+    if thread is None:
+        thread = get_thread_of_patch(patch)
+    author = thread.get_author_key(patch)
+    if author == -1 and len(thread.mails) > 1:
         _log.warning(patch)
 
-    for mail in list(LevelOrderIter(_threads.get_thread(patch))):
-        this_author = get_author_of_msg(mail)
-        if this_author is None:
-            continue
-        if this_author is not author:
-            return True
-    return False
+    return thread.has_foreign_response(author)
 
 
 def is_single_patch_ignored(patch):
+    if patch in _decisions:
+        return _decisions[patch]
+
+    decision = _is_single_patch_ignored(patch)
+    _decisions[patch] = decision
+    return decision
+
+
+def get_date_of_patch(patch):
+    """
+    Returns the date of a patch as naive datetime in UTC
+    """
+    metadata = _threads.metadata
+    row = metadata.find(patch) if metadata else None
+    if row is not None:
+        return datetime.datetime.utcfromtimestamp(int(metadata.dates[row]))
+
+    date = _repo[patch].date.astimezone(datetime.timezone.utc)
+    return date.replace(tzinfo=None)
+
+
+def _is_single_patch_ignored(patch, thread=None):
     try:
-        patch_mail = _repo[patch]
+        date = get_date_of_patch(patch)
     except KeyError:
         _statistic['error'].add(patch)
         return None
 
-    if _config.time_frame < patch_mail.date.replace(tzinfo=None):
+    if _config.time_frame < date:
         _statistic['too old'].add(patch)  # Patch is too new to be analyzed
         return None
 
-    if patch_has_foreign_response(patch):
+    if patch_has_foreign_response(patch, thread):
         _statistic['foreign response'].add(patch)
         return False
 
@@ -128,36 +262,36 @@ def is_single_patch_ignored(patch):
         _statistic['similar patch'].add(patch)
         return False
     _statistic['ignored'].add(patch)
+    return True
+
+
+def _get_root_children_by_author(patch):
+    thread = get_thread_of_patch(patch)
+    author = thread.get_author_key(patch)
+    return {child for child in thread.root_children
+            if thread.get_author_key(child) == author}
 
 
 def is_mail_cover_letter(patch):  # TODO
+    if _threads.series:
+        return _threads.series.get_cover_letter(patch) == patch
+
     # if mail has no in reply to
 
     # if mail has >1 children by same author
-    author = get_author_of_msg(patch)
-    children = _threads.get_thread(patch).children
-    mails_by_same_author = 0
-    for child in children:
-        if author is get_author_of_msg(child):
-            mails_by_same_author += 1
-
-    if mails_by_same_author < 2:
+    if len(_get_root_children_by_author(patch)) < 2:
         return False
     pass
 
 
 def _get_patch_set_of_cover_letter(patch):
-    children = _threads.get_thread(patch).children
-    author = get_author_of_msg(patch)
-    result = set()
-
-    for child in children:
-        if author is get_author_of_msg(child):
-            result.add(child)
-    return result
+    return _get_root_children_by_author(patch)
 
 
 def _get_cover_letter_of_patch_set(patch):  # TODO
+    if _threads.series:
+        return _threads.series.get_cover_letter(patch)
+
     # get thread
     # get node (patch)
     # get parent-node
@@ -165,9 +299,14 @@ def _get_cover_letter_of_patch_set(patch):  # TODO
 
 
 def get_patch_set_of_patch(patch):
-    if not is_part_of_patch_set(patch):
+    if patch is None or not is_part_of_patch_set(patch):
         return set()
 
+    # The series index knows all patches of a series. Only analysed patches
+    # are relevant, cover letters are not.
+    if _threads.series:
+        return set(_threads.series.get_series(patch)) & _patches
+
     if is_mail_cover_letter(patch):
         return _get_patch_set_of_cover_letter(patch)
     else:
@@ -176,19 +315,20 @@ def get_patch_set_of_patch(patch):
 
 def get_versions_of_patch(patch):
     global _clusters
-    cluster = _clusters.get_cluster(_clusters.get_key_of_element(patch))
+    cluster = _clusters.get_cluster(patch)
 
     if cluster is None:
         _statistic['error'].add(patch)
         return set()
 
-    if len(cluster) is 1:
+    if len(cluster) == 1:
         return set()
 
+    # Only patches (mails) are versions, upstream commits are not
     author = get_author_of_msg(patch)
     result = set()
-    for patch in cluster:
-        if get_author_of_msg(patch) is author:
+    for patch in cluster & _patches:
+        if get_author_of_msg(patch) == author:
             result.add(patch)
 
     return result
@@ -222,7 +362,8 @@ def get_versions_and_patch_sets(patch):
 
         # Clean up
         result_set |= current_iteration_set
-        if len(next_iteration_set) is 0:  # no new related patches found aborting analysis
+        next_iteration_set -= result_set
+        if len(next_iteration_set) == 0:  # no new related patches found aborting analysis
             return result_set
         else:
             current_iteration_set = next_iteration_set
@@ -251,7 +392,118 @@ def analyze_patch(patch):
     _statistic['ignored patch sets-versions'] |= patches
 
 
+def analyze_thread(patches):
+    """
+    Analyzes all patches of a thread together. The thread, the author keys of
+    its mails and its known authors are computed once, and the rules of all
+    patches of the thread are evaluated against them.
+    Patches are then aggregated with their related patches, which may live
+    in other threads of the component.
+    """
+    thread = get_thread_of_patch(patches[0])
+    for patch in patches:
+        if patch not in _decisions:
+            _decisions[patch] = _is_single_patch_ignored(patch, thread)
+
+    for patch in patches:
+        analyze_patch(patch)
+
+
+def group_by_thread(patches):
+    threads = dict()
+    for patch in patches:
+        root = get_root(patch)
+        threads.setdefault(root, list()).append(patch)
+    return threads
+
+
+def partition_patches(patches):
+    """
+    Partitions patches into connected components: patches are connected if
+    they share a thread or a cluster. Related patches (versions and patch
+    sets) never cross components, so components can be analysed
+    independently.
+    """
+    parent = dict()
+
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            parent[a] = b
+
+    for patch in patches:
+        union(patch, ('thread', get_root(patch)))
+        union(patch, ('cluster', _clusters.get_key_of_element(patch)))
+
+    components = dict()
+    for patch in patches:
+        components.setdefault(find(patch), list()).append(patch)
+
+    return list(components.values())
+
+
+def _chunks(components, chunksize):
+    chunk = list()
+    size = 0
+    for component in components:
+        chunk.append(component)
+        size += len(component)
+        if size >= chunksize:
+            yield chunk
+            chunk = list()
+            size = 0
+    if chunk:
+        yield chunk
+
+
+def _init_worker():
+    # Handles of the mailbox must not be shared with the parent process
+    for container in _repo.mbox.get_all_containers():
+        container.reopen()
+
+
+def _analyze_chunk(components):
+    """
+    Analyzes a chunk of components. Returns the partial statistic of the
+    chunk.
+    """
+    global _statistic
+    global _analyzed_patches
+
+    _statistic = new_statistic()
+    _analyzed_patches = set()
+
+    try:
+        for component in components:
+            threads = group_by_thread(component)
+            for root in sorted(threads):
+                analyze_thread(threads[root])
+    finally:
+        # Keep the memory of workers flat across chunks
+        reset_memos()
+
+    return _statistic
+
+
 def ignored_patches(config, prog, argv):
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Analyse ignored patches')
+    parser.add_argument('-cpu', dest='cpu_factor', metavar='cpu', type=float,
+                        default=1.0, help='CPU factor for parallelisation '
+                                          '(default: %(default)s)')
+    parser.add_argument('-o', dest='f_result', metavar='filename',
+                        default=datetime.datetime.now().strftime(
+                            '%Y.%m.%d-%H:%M_ignored_patches.tsv'),
+                        help='Result TSV file (default: %(default)s)')
+    args = parser.parse_args(argv)
+
     global _log
     if config.mode != config.Mode.MBOX:
         _log.error('Only works in Mbox mode!')
@@ -260,7 +512,6 @@ def ignored_patches(config, prog, argv):
     global _config
     global _repo
     global _clusters
-    global _statistic
     global _patches
     global _threads
 
@@ -272,18 +523,32 @@ def ignored_patches(config, prog, argv):
     f_cluster, _clusters = config.load_patch_groups(must_exist=True)
     _clusters.optimize()
 
-    _statistic['all patches'] = _clusters.get_tagged() | _clusters.get_untagged()
-    _statistic['upstream patches'] = _clusters.get_tagged()
-    _statistic['analyzed patches'] = _clusters.get_untagged()
-
     _patches = _clusters.get_untagged()
 
     _threads = _repo.mbox.load_threads()
 
-    _log.info('Analyzing patches…')
-    for patch in tqdm(_patches):
-        analyze_patch(patch)
+    _log.info('Partitioning patches by threads and clusters…')
+    components = partition_patches(_patches)
+    components.sort(key=len, reverse=True)
+    reset_memos()
+    chunks = list(_chunks(components, 100))
+
+    _log.info('Analyzing %d patches in %d components…' %
+              (len(_patches), len(components)))
+    sink = StatisticSink(args.f_result)
+    processes = int(args.cpu_factor * cpu_count())
+    if processes > 1:
+        with Pool(processes, initializer=_init_worker) as p:
+            for partial in tqdm(p.imap_unordered(_analyze_chunk, chunks),
+                                total=len(chunks)):
+                sink.write_statistic(partial)
+    else:
+        for chunk in tqdm(chunks):
+            sink.write_statistic(_analyze_chunk(chunk))
 
-    write_and_print_statistic()
+    sink.write('all patches', _clusters.get_tagged() | _clusters.get_untagged())
+    sink.write('upstream patches', _clusters.get_tagged())
+    sink.write('analyzed patches', _patches)
+    sink.close()
 
     return
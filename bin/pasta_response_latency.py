@@ -0,0 +1,53 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2019
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import os
+import sys
+
+from logging import getLogger
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from pypasta import *
+from pypasta.Repository.ThreadAnalytics import response_statistics, \
+    write_columns
+
+log = getLogger(__name__[-15:])
+
+
+def response_latency(config, prog, argv):
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Analyse responses to '
+                                                 'patches on mailing lists')
+    parser.add_argument('-o', dest='f_result', metavar='filename',
+                        default='response_latency.tsv',
+                        help='Result TSV file (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    if config.mode != config.Mode.MBOX:
+        log.error('Only works in Mbox mode!')
+        return -1
+
+    threads = config.repo.mbox.load_threads()
+    if not threads.index or not threads.series or not threads.metadata:
+        log.error('Mail thread index missing. Run sync first.')
+        return -1
+
+    # Patches are all mails of series, except for cover letters
+    series = threads.series
+    patches = [series.message_id(row) for row in range(series.num)
+               if series.numbers[row] != 0]
+
+    log.info('Analysing responses of %d patches...' % len(patches))
+    columns = response_statistics(threads.index, threads.metadata, patches)
+    write_columns(args.f_result, columns)
+    log.info('  ↪ %d patches written to %s' %
+             (len(columns['message_id']), args.f_result))
@@ -18,6 +18,7 @@ from logging import getLogger
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
                                                 '..')))
 from pypasta import *
+from pypasta.Repository.MailThread import MailThread
 
 log = getLogger(__name__[-15:])
 
@@ -60,6 +61,10 @@ def sync(config, prog, argv):
                         help='synchronise mailboxes before creating caches')
     parser.add_argument('-noup', action='store_true', default=False,
                         help='Don\'t synchronise upstream repositories')
+    parser.add_argument('-pack', action='store_true', default=False,
+                        help='convert raw mailboxes to mail packs')
+    parser.add_argument('-zstd', action='store_true', default=False,
+                        help='compress mails in packs with zstd')
 
     args = parser.parse_args(argv)
     repo = config.repo
@@ -78,6 +83,12 @@ def sync(config, prog, argv):
         if is_mbox and args.mbox:
             repo.update_mbox(config)
 
+    if is_mbox and args.pack:
+        missing = repo.mbox.mbox_raw.pack(args.zstd or None)
+        # Indexed mails without raw mail can not be read anymore
+        if missing:
+            repo.mbox.invalidate(missing)
+
     if args.clear is None and args.create is None:
         args.create = 'all'
 
@@ -90,7 +101,7 @@ def sync(config, prog, argv):
         remove_if_exist(config.f_ccache_upstream)
     if clear_mbox:
         remove_if_exist(config.f_ccache_mbox)
-        remove_if_exist(config.f_mail_thread_cache)
+        MailThread.clear(config.f_mail_thread_cache)
 
     if create_stack:
         config.update_ccache_stack()
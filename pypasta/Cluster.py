@@ -10,21 +10,47 @@ This work is licensed under the terms of the GNU GPL, version 2.  See
 the COPYING file in the top-level directory.
 """
 
+import numpy as np
+
 from logging import getLogger
+from time import time
 
 log = getLogger(__name__[-15:])
 
 
 class Cluster:
     SEPARATOR = '=>'
+    RANKS_SUFFIX = '.ranks'
 
     def __init__(self):
         self.classes = list()
         self.lookup = dict()
         self.tags = set()
 
+        # Elements may be ranked. The representative of a class is its untagged
+        # element with the highest rank. Representatives are maintained for
+        # each class, so self.representatives runs in parallel to self.classes
+        self.ranks = dict()
+        self.representatives = list()
+
+        # Sorted keys and their indices, see get_key_index(). Invalidated as
+        # soon as the set of keys changes.
+        self._sorted_keys = None
+        self._key_index = None
+
+    def _invalidate_keys(self):
+        self._sorted_keys = None
+        self._key_index = None
+
+    def _get_sorted_keys(self):
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self.lookup)
+        return self._sorted_keys
+
     def optimize(self):
         # get optimized list by filtering orphaned elements
+        self.representatives = [rep for elems, rep in
+                                zip(self.classes, self.representatives) if elems]
         self.classes = list(filter(None, self.classes))
 
         # reset lookup table
@@ -44,8 +70,10 @@ class Cluster:
         id = self.lookup[representative]
 
         elems = self.classes.pop(id)
+        self.representatives.pop(id)
         for elem in elems:
             self.lookup.pop(elem)
+        self._invalidate_keys()
 
         for elem in elems:
             self.insert_single(elem)
@@ -54,8 +82,12 @@ class Cluster:
 
     def remove_key(self, key):
         self.tags.discard(key)
+        self.ranks.pop(key, None)
         id = self.lookup.pop(key)
+        self._invalidate_keys()
         self.classes[id].remove(key)
+        if self.representatives[id] == key:
+            self._elect_representative(id)
 
     def remove_single_element_clusters(self):
         single_element_clusters = set()
@@ -99,26 +131,51 @@ class Cluster:
             return self.lookup[elem]
 
         self.classes.append(set([elem]))
+        self.representatives.append(None if elem in self.tags else elem)
         id = len(self.classes) - 1
         self.lookup[elem] = id
+        self._invalidate_keys()
 
         return id
 
+    def _rank_key(self, elem):
+        # Unranked elements are inferior to ranked elements. Ties are broken by
+        # the element itself to keep the representative system deterministic.
+        rank = self.ranks.get(elem)
+        return rank is not None, rank or 0, elem
+
+    def _elect_representative(self, id):
+        untagged = self.classes[id] - self.tags
+        self.representatives[id] = \
+            max(untagged, key=self._rank_key) if untagged else None
+
+    def _nominate_representative(self, id, elem):
+        rep = self.representatives[id]
+        if rep is None or self._rank_key(elem) > self._rank_key(rep):
+            self.representatives[id] = elem
+
     def _merge_ids(self, *ids):
         new_class = set()
         new_id = min(ids)
+        candidates = set()
 
         for id in ids:
             for elem in self.classes[id]:
                 self.lookup[elem] = new_id
             new_class |= self.classes[id]
             self.classes[id] = set()
+            candidates.add(self.representatives[id])
+            self.representatives[id] = None
 
         self.classes[new_id] = new_class
+        candidates.discard(None)
+        if candidates:
+            self.representatives[new_id] = max(candidates, key=self._rank_key)
 
         # truncate empty trailing list elements
         while not self.classes[-1]:
             self.classes.pop()
+            self.representatives.pop()
 
         return new_id
 
@@ -138,17 +195,60 @@ class Cluster:
         return self.lookup[key]
 
     def tag(self, key, tag=True):
+        was_tagged = key in self.tags
         if tag is True:
             self.tags.add(key)
         else:
             self.tags.discard(key)
 
+        if key not in self.lookup or was_tagged == (key in self.tags):
+            return
+
+        id = self.lookup[key]
+        if tag is True:
+            if self.representatives[id] == key:
+                self._elect_representative(id)
+        else:
+            self._nominate_representative(id, key)
+
     def has_tag(self, key):
         return key in self.tags
 
     def get_keys(self):
         return set(self.lookup.keys())
 
+    def get_key_index(self):
+        """
+        Returns a stable mapping of all keys to consecutive integers. Keys are
+        enumerated in sorted order. The mapping is cached and must not be
+        modified.
+        """
+        if self._key_index is None:
+            self._key_index = {key: index for index, key
+                               in enumerate(self._get_sorted_keys())}
+        return self._key_index
+
+    def get_labels(self, keys=None):
+        """
+        Returns a compact NumPy array that contains the class id of each key.
+        If keys is not specified, all keys are regarded in the order of
+        get_key_index(). Keys that are not part of the cluster are labelled as
+        single-element classes.
+        """
+        if keys is None:
+            keys = self._get_sorted_keys()
+
+        lookup = self.lookup
+        labels = np.fromiter((lookup.get(key, -1) for key in keys),
+                             dtype=np.int64)
+
+        missing = labels == -1
+        num_classes = len(self.classes)
+        labels[missing] = np.arange(num_classes,
+                                    num_classes + np.count_nonzero(missing))
+
+        return labels
+
     def get_cluster(self, key):
         """
         Given a key, this function returns all elements of the cluster as a set
@@ -214,10 +314,40 @@ class Cluster:
 
         return retval
 
+    def set_rank(self, key, rank):
+        """
+        Sets the rank of a key. Ranks determine the representatives of classes.
+        """
+        self.ranks[key] = rank
+        if key not in self.lookup or key in self.tags:
+            return
+
+        id = self.lookup[key]
+        if self.representatives[id] == key:
+            self._elect_representative(id)
+        else:
+            self._nominate_representative(id, key)
+
+    def get_unranked(self):
+        """
+        Returns all untagged entries that have no rank.
+        """
+        return {x for x in self.lookup.keys()
+                if x not in self.ranks and x not in self.tags}
+
+    def get_representatives(self):
+        """
+        Return the complete representative system of the equivalence class,
+        determined by the ranks of its elements. Only untagged entries are
+        considered.
+        """
+        return {rep for rep in self.representatives if rep is not None}
+
     def get_representative_system(self, compare_function):
         """
         Return a complete representative system of the equivalence class. Only
-        untagged entries are considered.
+        untagged entries are considered. In contrast to get_representatives(),
+        the representative system is determined from scratch.
 
         :param compare_function: a function that compares two elements of an
                                  equivalence class
@@ -274,39 +404,72 @@ class Cluster:
         with open(filename, 'w') as f:
             f.write(str(self))
 
+        if self.ranks:
+            with open(filename + Cluster.RANKS_SUFFIX, 'w') as f:
+                f.write(''.join(['%s %r\n' % (key, rank) for key, rank
+                                 in sorted(self.ranks.items())]))
+
     def get_key_of_element(self, elem):
         return self.lookup[elem]
 
+    def _load_line(self, line):
+        untagged, _, tagged = line.partition(Cluster.SEPARATOR)
+        untagged, tagged = untagged.split(), tagged.split()
+        elems = untagged + tagged
+        if not elems:
+            return 0
+
+        # Lines of a persisted cluster describe disjoint classes. Hence, we can
+        # directly create the class and its lookup entries. Only fall back to
+        # the slow merge path if the file contains overlapping lines.
+        lookup = self.lookup
+        if any(elem in lookup for elem in elems):
+            self.insert(*elems)
+            for tag in tagged:
+                self.tag(tag)
+        else:
+            id = len(self.classes)
+            self.classes.append(set(elems))
+            self.representatives.append(
+                max(untagged, key=self._rank_key) if untagged else None)
+            for elem in elems:
+                lookup[elem] = id
+            self.tags.update(tagged)
+            self._invalidate_keys()
+
+        return len(elems)
+
     @staticmethod
     def from_file(filename, must_exist=False):
-        def split_elements(elems):
-            return list(filter(None, elems.split(' ')))
-
         retval = Cluster()
 
         try:
-            with open(filename, 'r') as f:
-                content = f.read()
+            f = open(filename, 'r')
         except FileNotFoundError:
             log.warning('Equivalence class not found: %s' % filename)
             if must_exist:
                 raise
             return retval
 
-        if not (content and len(content)):
-            return retval
+        start = time()
+        elements = 0
 
-        content = list(filter(None, content.splitlines()))
-        for line in content:
-            line = line.split(Cluster.SEPARATOR)
-            # Append empty tagged list, if not present
-            if len(line) == 1:
-                line.append('')
+        try:
+            with open(filename + Cluster.RANKS_SUFFIX, 'r') as r:
+                for line in r:
+                    key, rank = line.split()
+                    retval.ranks[key] = float(rank)
+        except FileNotFoundError:
+            pass
 
-            untagged, tagged = split_elements(line[0]), split_elements(line[1])
+        with f:
+            for line in f:
+                elements += retval._load_line(line)
+        duration = time() - start
 
-            retval.insert(*(untagged + tagged))
-            for tag in tagged:
-                retval.tag(tag)
+        log.info('  ↪ loaded %d elements in %d clusters from %s '
+                 '(%0.2fs, %d elements/s)' %
+                 (elements, len(retval), filename, duration,
+                  elements / duration if duration else elements))
 
         return retval
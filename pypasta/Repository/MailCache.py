@@ -0,0 +1,133 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2019
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+from collections import Counter, defaultdict
+from logging import getLogger
+from multiprocessing import Pool, cpu_count
+from time import time
+from tqdm import tqdm
+
+log = getLogger(__name__[-15:])
+
+# Worker processes inherit the mailbox, and reopen its handles on start-up
+_mbox = None
+
+
+def reopen_containers(mbox):
+    for container in mbox.get_all_containers():
+        container.reopen()
+
+
+def _init_worker():
+    reopen_containers(_mbox)
+
+
+def _failure_reason(exception):
+    # PatchMail raises TypeErrors with descriptive messages
+    if isinstance(exception, (KeyError, TypeError)):
+        return str(exception).strip('\'"')
+    return type(exception).__name__
+
+
+def _build_batch(args):
+    source, message_ids = args
+    container = _mbox.sources[source][1]
+
+    start = time()
+    results = list()
+    reasons = Counter()
+    for message_id in message_ids:
+        patch, exception = _mbox.get_patch_mail(message_id, container)
+        if patch is None:
+            reasons[_failure_reason(exception)] += 1
+        results.append((message_id, patch))
+
+    return source, results, reasons, time() - start
+
+
+def shard_batches(mbox, message_ids, batchsize):
+    """
+    Partitions a set of Message-IDs by the source (e.g., the shard of a public
+    inbox) that contains them. A batch only contains mails of one source,
+    ordered for sequential reads.
+
+    :return: tuple of the list of (source, message_ids) batches and the list
+             of Message-IDs that are not part of any source
+    """
+    shards = defaultdict(list)
+    missing = list()
+    for message_id in message_ids:
+        sources = mbox.router.lookup(message_id)
+        if sources:
+            shards[sources[0]].append(message_id)
+        else:
+            missing.append(message_id)
+
+    batches = list()
+    for source, ids in sorted(shards.items()):
+        ids = mbox.sources[source][1].reading_order(ids)
+        batches += [(source, ids[i:i + batchsize])
+                    for i in range(0, len(ids), batchsize)]
+
+    return batches, missing
+
+
+def build_patch_mails(mbox, message_ids, processes=None, parallelise=True,
+                      batchsize=500):
+    """
+    Creates PatchMails of a set of Message-IDs in batches of shard_batches().
+
+    :return: list of (message_id, PatchMail) tuples. The PatchMail is None if
+             the mail could not be parsed.
+    """
+    global _mbox
+
+    worklist, missing = shard_batches(mbox, message_ids, batchsize)
+    results = [(message_id, None) for message_id in missing]
+    if results:
+        log.info('  ↪ %d mails not found' % len(results))
+
+    stats = defaultdict(lambda: [0, 0.0, Counter()])
+
+    _mbox = mbox
+    p = None
+    try:
+        if parallelise:
+            p = Pool(processes or cpu_count(), initializer=_init_worker)
+            batches = p.imap_unordered(_build_batch, worklist)
+        else:
+            batches = map(_build_batch, worklist)
+
+        for source, result, reasons, duration in tqdm(batches,
+                                                      total=len(worklist)):
+            results += result
+            stat = stats[source]
+            stat[0] += len(result)
+            stat[1] += duration
+            stat[2].update(reasons)
+    finally:
+        # Do not leak workers if a batch or the merge fails
+        if p:
+            p.close()
+            p.join()
+        _mbox = None
+
+    for source, (processed, duration, reasons) in sorted(stats.items()):
+        listname, container = mbox.sources[source][0:2]
+        listname = getattr(container, 'listname', listname)
+        log.info('  ↪ %s: %d mails, %d failed, %0.2f mails/s' %
+                 (listname, processed, sum(reasons.values()),
+                  processed / duration if duration else processed))
+        for reason, count in reasons.most_common():
+            log.info('    ↪ %d: %s' % (count, reason))
+
+    return results
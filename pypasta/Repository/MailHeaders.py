@@ -0,0 +1,225 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2019
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import datetime
+import dateparser
+import email
+import re
+
+from collections import Counter
+from email.header import decode_header, make_header
+from functools import lru_cache
+
+HEADER_END_REGEX = re.compile(rb'\r?\n\r?\n')
+HEADER_LINE_REGEX = re.compile(rb'\r?\n')
+
+# Normalisations of timezones that parsedate silently drops: +01:00, GMT+0100
+TZ_COLON_REGEX = re.compile(r'([+-]\d{2}):(\d{2})(\s*(\(.*\))?\s*)$')
+TZ_GMT_REGEX = re.compile(r'\b(?:GMT|UTC)([+-]\d{4})\b')
+
+# Known malformed date formats that are not understood by parsedate
+ISO_DATE_REGEX = re.compile(r'^\s*(\d{4})-(\d{1,2})-(\d{1,2})[T ]+'
+                            r'(\d{1,2}):(\d{2})(?::(\d{2}))?(?:\.\d+)?\s*'
+                            r'(Z|[+-]\d{2}:?\d{2})?\s*$')
+DAY_ONLY_REGEX = re.compile(r'^\s*(?:[A-Za-z]+,?\s+)?(\d{1,2})[\s-]+'
+                            r'([A-Za-z]{3})[A-Za-z]*\.?[\s-]+(\d{4})\s*$')
+MONTHS = {month: no + 1 for no, month in
+          enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug',
+                     'sep', 'oct', 'nov', 'dec'])}
+
+# Number of parsed dates per layer, see parse_date_stats()
+_date_stats = Counter()
+
+
+def _parse_tz(tz):
+    if tz is None:
+        return None
+    if tz == 'Z':
+        return datetime.timezone.utc
+
+    sign = -1 if tz[0] == '-' else 1
+    tz = tz[1:].replace(':', '')
+    offset = datetime.timedelta(hours=int(tz[0:2]), minutes=int(tz[2:4]))
+    return datetime.timezone(sign * offset)
+
+
+def _parse_date_formats(date_str):
+    match = ISO_DATE_REGEX.match(date_str)
+    if match:
+        year, month, day, hour, minute, second, tz = match.groups()
+        return datetime.datetime(int(year), int(month), int(day), int(hour),
+                                 int(minute), int(second or 0),
+                                 tzinfo=_parse_tz(tz))
+
+    match = DAY_ONLY_REGEX.match(date_str)
+    if match:
+        day, month, year = match.groups()
+        month = MONTHS.get(month.lower())
+        if month:
+            return datetime.datetime(int(year), month, int(day))
+
+    return None
+
+
+@lru_cache(maxsize=1 << 16)
+def _parse_date(date_str):
+    normalised = TZ_GMT_REGEX.sub(r'\1', TZ_COLON_REGEX.sub(r'\1\2\3',
+                                                           date_str))
+    try:
+        date = email.utils.parsedate_to_datetime(normalised)
+    except Exception:
+        date = None
+    if date:
+        _date_stats['rfc'] += 1
+        return date
+
+    try:
+        date = _parse_date_formats(date_str)
+    except ValueError:
+        date = None
+    if date:
+        _date_stats['format'] += 1
+        return date
+
+    # Last resort, and slow: dateparser
+    _date_stats['dateparser'] += 1
+    try:
+        date = dateparser.parse(date_str)
+    except Exception:
+        date = None
+    if not date:
+        _date_stats['failed'] += 1
+
+    return date
+
+
+def mail_parse_date(date_str):
+    """
+    Parses the date of a mail. Dates are parsed in layers: RFC 2822 dates,
+    known malformed formats and, as a last resort, dateparser. Results are
+    memoised, as archives contain many recurring dates.
+    """
+    if not date_str:
+        return None
+
+    # email.message returns unhashable Header objects for encoded headers
+    if not isinstance(date_str, str):
+        date_str = str(date_str)
+
+    _date_stats['total'] += 1
+    return _parse_date(date_str)
+
+
+def parse_date_stats(reset=False):
+    """
+    Returns the number of dates that were parsed in this process, by layer.
+    Dates that were neither parsed by any layer nor failed hit the cache.
+    """
+    stats = Counter(_date_stats)
+    stats['cached'] = stats['total'] - \
+        sum(stats[x] for x in ['rfc', 'format', 'dateparser'])
+    if reset:
+        _date_stats.clear()
+    return stats
+
+
+def log_date_stats(log, stats):
+    if not stats['total']:
+        return
+
+    log.info('  ↪ parsed %d dates: %d cached, %d RFC 2822, %d known formats, '
+             '%d dateparser (%d failed)' %
+             (stats['total'], stats['cached'], stats['rfc'], stats['format'],
+              stats['dateparser'], stats['failed']))
+
+
+def get_header_bytes(raw):
+    """
+    Returns the header section of a raw mail, i.e., everything up to the first
+    empty line
+    """
+    match = HEADER_END_REGEX.search(raw)
+    if not match:
+        return raw
+    return raw[:match.end()]
+
+
+def decode_value(value):
+    """
+    Decodes RFC 2047 encoded words of a header value
+    """
+    if '=?' not in value:
+        return value
+
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+class MailHeaders:
+    """
+    Headers of a mail. Only the header section of the raw mail is scanned,
+    the body is never touched. Folded headers are unfolded, and encoded words
+    are decoded. Lookups are case-insensitive and follow the semantics of
+    email.message.Message.
+    """
+    def __init__(self, raw):
+        self.headers = list()
+
+        name = None
+        value = list()
+        for line in HEADER_LINE_REGEX.split(get_header_bytes(raw)):
+            # Continuation of a folded header
+            if line[:1] in (b' ', b'\t'):
+                if name is not None:
+                    value.append(line)
+                continue
+
+            if name is not None:
+                self._add(name, value)
+                name = None
+
+            # Skips the From_ line of mbox files and the final empty line
+            colon = line.find(b':')
+            header = line[:colon].rstrip(b' \t') if colon > 0 else None
+            if not header or b' ' in header:
+                continue
+
+            name = header
+            value = [line[colon + 1:]]
+
+        if name is not None:
+            self._add(name, value)
+
+    def _add(self, name, value):
+        name = name.decode('ascii', 'replace').lower()
+        value = b''.join(value).decode('utf-8', 'surrogateescape').strip()
+        self.headers.append((name, decode_value(value)))
+
+    def get_all(self, name, failobj=None):
+        name = name.lower()
+        values = [v for k, v in self.headers if k == name]
+        return values or failobj
+
+    def get(self, name, failobj=None):
+        name = name.lower()
+        for k, v in self.headers:
+            if k == name:
+                return v
+        return failobj
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
@@ -0,0 +1,251 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2019
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import mmap
+import os
+import re
+
+from collections import Counter
+from hashlib import md5
+from logging import getLogger
+from multiprocessing import Pool, cpu_count
+from time import time
+from tqdm import tqdm
+
+from .MailHeaders import MailHeaders, log_date_stats, mail_parse_date, \
+    parse_date_stats
+
+log = getLogger(__name__[-15:])
+
+MESSAGE_ID_REGEX = re.compile(r'.*(<.*>).*')
+# From_ lines look like 'From sender Mon Jan  1 00:00:00 2019'
+MBOX_FROM_REGEX = re.compile(rb'(?:^|\n)From [^ \n]+ +[A-Za-z]{3} +[A-Za-z]{3} +\d')
+DOTTED_TIME_REGEX = re.compile(r'(.*)\s(.*)\.(.*)\.(.*)\s(.*)')
+WHITESPACE_REGEX = re.compile(r"[\s']")
+
+
+def mbox_messages(f_mbox):
+    """
+    Streams the locations of all messages of an mbox file as tuples of
+    (filename, offset, length). Messages are separated by From_ lines.
+    """
+    if os.path.getsize(f_mbox) == 0:
+        return
+
+    with open(f_mbox, 'rb') as f, \
+         mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = None
+        for match in MBOX_FROM_REGEX.finditer(mm):
+            # Skip the newline of the previous message
+            begin = match.start() if match.start() == 0 else match.start() + 1
+            if start is not None:
+                yield f_mbox, start, begin - start
+            start = begin
+
+        if start is not None:
+            yield f_mbox, start, len(mm) - start
+
+
+def maildir_messages(d_maildir):
+    """
+    Streams the locations of all messages (i.e., files) of a maildir
+    """
+    for root, _, files in os.walk(d_maildir):
+        for file in sorted(files):
+            yield os.path.join(root, file), 0, -1
+
+
+def read_message(filename, offset, length):
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def _parse_date(date_str):
+    if not date_str:
+        return None
+
+    date = mail_parse_date(date_str)
+    if not date:
+        return None
+
+    # Like date(1), convert to local time
+    if date.tzinfo:
+        date = date.astimezone()
+
+    if date.year < 1970:
+        return None
+
+    return date.strftime('%Y/%m/%d')
+
+
+def parse_message(raw):
+    """
+    Determines Message-ID, its MD5 and the date of a raw mail. This follows
+    the rules of the former tools/process_mail.sh. Only headers are parsed.
+
+    :return: tuple of (message_id, md5, date) or None, if the mail can not be
+             parsed
+    """
+    headers = MailHeaders(raw)
+
+    def last(header):
+        values = headers.get_all(header)
+        if not values:
+            return None
+        return values[-1]
+
+    message_id = last('Message-ID')
+    if not message_id:
+        return None
+    match = MESSAGE_ID_REGEX.match(message_id)
+    if match:
+        message_id = match.group(1)
+    message_id = message_id.strip()
+    if not message_id or WHITESPACE_REGEX.search(message_id):
+        return None
+
+    date_hdr = last('Date')
+    date = _parse_date(date_hdr)
+    if not date and date_hdr:
+        date = _parse_date(DOTTED_TIME_REGEX.sub(r'\1 \2:\3:\4 \5', date_hdr))
+    if not date:
+        date = _parse_date(last('NNTP-Posting-Date'))
+    if not date:
+        # last chance, try to use the Received field
+        received = last('Received')
+        if received and ';' in received:
+            date = _parse_date(received.rsplit(';', 1)[1].strip())
+    if not date:
+        return None
+
+    return message_id, md5(message_id.encode()).hexdigest(), date
+
+
+def _ingest_batch(args):
+    d_mbox_raw, batch = args
+    lines = list()
+    failed = list()
+    raws = list()
+
+    for location in batch:
+        raw = read_message(*location)
+        try:
+            result = parse_message(raw)
+        except Exception:
+            result = None
+
+        if not result:
+            failed.append(location)
+            continue
+
+        message_id, hash, date = result
+        lines.append('%s %s %s\n' % (date, message_id, hash))
+
+        # Without a raw directory, mails are returned to the caller
+        if d_mbox_raw is None:
+            raws.append((message_id, raw))
+            continue
+
+        d_dst = os.path.join(d_mbox_raw, date)
+        f_dst = os.path.join(d_dst, hash)
+        if not os.path.isfile(f_dst):
+            os.makedirs(d_dst, exist_ok=True)
+            with open(f_dst, 'wb') as f:
+                f.write(raw)
+
+    return lines, failed, raws, parse_date_stats(reset=True)
+
+
+def _batches(messages, batchsize):
+    batch = list()
+    for message in messages:
+        batch.append(message)
+        if len(batch) == batchsize:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+def ingest(listname, d_mbox, f_mbox_raw, pack=None, compress=None,
+           parallelise=True, batchsize=1000):
+    """
+    Imports a mailbox (mbox file or maildir) to the raw mail storage of PaStA.
+    Mails are placed in d_mbox/raw/YYYY/MM/DD/<md5 of Message-ID>, or appended
+    to pack, if given. Mails are indexed in d_mbox/index/raw.<listname>.
+    Mails are compressed in the mode of pack, unless compress is given.
+
+    :return: tuple of (success, set of ingested Message-IDs)
+    """
+    d_mbox_raw = os.path.join(d_mbox, 'raw')
+    f_index = os.path.join(d_mbox, 'index', 'raw.%s' % listname)
+    os.makedirs(os.path.dirname(f_index), exist_ok=True)
+
+    if os.path.isdir(f_mbox_raw):
+        messages = maildir_messages(f_mbox_raw)
+    else:
+        messages = mbox_messages(f_mbox_raw)
+    if pack is not None:
+        d_mbox_raw = None
+    worklist = ((d_mbox_raw, batch) for batch in _batches(messages, batchsize))
+
+    start = time()
+    processed = 0
+    failed = 0
+    date_stats = Counter()
+    message_ids = set()
+
+    with open(f_index, 'a') as index:
+        if parallelise:
+            p = Pool(cpu_count())
+            results = p.imap(_ingest_batch, worklist)
+        else:
+            results = map(_ingest_batch, worklist)
+
+        def consume():
+            nonlocal processed, failed
+            for lines, fails, raws, stats in tqdm(results, unit='batch'):
+                date_stats.update(stats)
+                index.write(''.join(lines))
+                message_ids.update(line.split(' ')[1] for line in lines)
+                processed += len(lines) + len(fails)
+                failed += len(fails)
+                for location in fails:
+                    log.debug('Unable to process mail at %s:%d' % location[0:2])
+                yield from raws
+
+        # The pack is written in one go to avoid rewriting its offset index
+        # for every batch
+        if pack is not None:
+            pack.add(consume(), compress)
+        else:
+            for _ in consume():
+                pass
+
+        if parallelise:
+            p.close()
+            p.join()
+
+    # Keep the index sorted and free of duplicates
+    with open(f_index, 'r') as f:
+        lines = sorted(set(f.read().splitlines()))
+    with open(f_index, 'w') as f:
+        f.write(''.join(['%s\n' % x for x in lines if x]))
+
+    duration = time() - start
+    log.info('  ↪ processed %d mails (%d failed) in %0.2fs: %0.2f mails/s' %
+             (processed, failed, duration,
+              processed / duration if duration else processed))
+    log_date_stats(log, date_stats)
+
+    return failed == 0, message_ids
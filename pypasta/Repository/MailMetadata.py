@@ -0,0 +1,458 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2019
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import datetime
+import mmap
+import numpy as np
+import os
+import re
+
+from email.utils import parseaddr
+from logging import getLogger
+
+from .MailHeaders import mail_parse_date
+from .MessageIndex import encode_ids, insert_rows, message_id_hash, \
+    message_id_hashes, splice_ids
+from .PatchSeries import parse_subject
+
+log = getLogger(__name__[-15:])
+
+SUBJECT_PREFIX_REGEX = re.compile(r'^\s*((re|aw|fwd?)\s*:\s*|\[[^\]]*\]\s*)*',
+                                  re.IGNORECASE)
+WHITESPACE_REGEX = re.compile(r'\s+')
+
+
+def _sanitise(value):
+    if not value:
+        return ''
+    return WHITESPACE_REGEX.sub(' ', value).strip()
+
+
+def _timestamp(date):
+    """
+    Returns the seconds since epoch of a datetime or date. Naive datetimes are
+    in UTC, like the dates of the mail indices.
+    """
+    if not isinstance(date, datetime.datetime):
+        date = datetime.datetime.combine(date, datetime.time.min)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return int(date.timestamp())
+
+
+def parse_author(from_header):
+    """
+    Returns the (name, address) of the author of a From header. Addresses
+    are lowercase.
+    """
+    name, address = parseaddr(from_header or '')
+    return _sanitise(name), _sanitise(address).lower()
+
+
+def journal_line(message_id, from_header, date_header, subject):
+    """
+    Returns the line of a mail in the metadata journal (tab-separated):
+    Message-ID, author name, author address, date (seconds since epoch) and
+    subject
+    """
+    name, address = parse_author(from_header)
+
+    date = mail_parse_date(date_header)
+    if date is None:
+        # assume epoch, like PatchMail
+        date = 0
+    else:
+        date = _timestamp(date)
+
+    return '%s\t%s\t%s\t%d\t%s\n' % (message_id, name, address, date,
+                                     _sanitise(subject))
+
+
+def load_journal(f_journal):
+    """
+    Returns a dict of Message-ID -> (name, address, date, subject)
+    """
+    mails = dict()
+    if not os.path.isfile(f_journal):
+        return mails
+
+    with open(f_journal, 'r') as f:
+        for line in f:
+            message_id, metadata = parse_journal_line(line)
+            mails[message_id] = metadata
+
+    return mails
+
+
+def parse_journal_line(line):
+    """
+    Returns a (Message-ID, (name, address, date, subject)) tuple of a line of
+    the metadata journal
+    """
+    message_id, name, address, date, subject = line.rstrip('\n').split('\t')
+    return message_id, (name, address, int(date), subject)
+
+
+def subject_hash(subject):
+    """
+    Returns a hash of a subject without prefixes, like Re: or [PATCH v2 1/2]
+    """
+    return message_id_hash(SUBJECT_PREFIX_REGEX.sub('', subject).lower())
+
+
+class StringTable:
+    """
+    Table of distinct strings, e.g., author names. Strings are identified by
+    their position in the table.
+    """
+    def __init__(self, strings=()):
+        self.strings = list(strings)
+        self.ids = {x: id for id, x in enumerate(self.strings)}
+
+    def get_id(self, string):
+        id = self.ids.get(string)
+        if id is None:
+            id = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return id
+
+    def get_ids(self, strings):
+        return np.fromiter((self.get_id(x) for x in strings), dtype='<i4',
+                           count=len(strings))
+
+
+class MailMetadata:
+    """
+    Columnar metadata of all mails, stored as NumPy arrays in d_meta. Rows are
+    sorted by the hash of the Message-ID. Columns:
+      - hashes:   64-bit hashes of Message-IDs
+      - offsets:  offsets of the Message-IDs in the Message-ID blob
+      - names:    id of the author name, see get_names()
+      - emails:   id of the author address, see get_emails()
+      - dates:    seconds since epoch
+      - lists:    membership of the mailing lists of a mail, see get_lists().
+                  One bit per list, in 64-bit words per row. The number of
+                  words grows with the number of lists.
+      - roots:    row of the root of the thread (-1, if not part of the table)
+      - subjects: hash of the subject without prefixes
+      - versions, numbers, totals: the [PATCH vN m/n] prefix of the subject.
+                  numbers is -1, if the mail is no patch
+    Columns are memory-mapped, so aggregate analyses are vectorised filters
+    that never touch mails or the commit cache.
+
+    The table is built from a journal with one line per mail (see
+    journal_line()) that is appended while the mail thread cache is updated.
+    Later updates merge new mails into the table.
+    """
+    JOURNAL_SUFFIX = '.meta'
+    SUFFIX = '.meta.d'
+    COLUMNS = ['hashes', 'offsets', 'names', 'emails', 'dates', 'lists',
+               'roots', 'subjects', 'versions', 'numbers', 'totals']
+    # String tables, one entry per line
+    TABLES = ['name_table', 'email_table', 'list_table']
+
+    def __init__(self, d_meta):
+        self.d_meta = d_meta
+        for column in MailMetadata.COLUMNS:
+            setattr(self, column, np.load(os.path.join(d_meta,
+                                                       column + '.npy'),
+                                          mmap_mode='r'))
+        self._tables = dict()
+
+        self.mm = None
+        if self.offsets[-1]:
+            with open(os.path.join(d_meta, 'ids'), 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def load(d_meta):
+        f_marker = os.path.join(d_meta, MailMetadata.COLUMNS[-1] + '.npy')
+        if not os.path.isfile(f_marker):
+            return None
+        return MailMetadata(d_meta)
+
+    @staticmethod
+    def _columns(mails, ids, names, emails, list_table, get_lists):
+        """
+        Returns the columns of mails, except for roots
+        """
+        num = len(ids)
+        values = [mails[x] for x in ids]
+        patches = [parse_subject(x[3]) or (0, -1, 0) for x in values]
+
+        return {
+            'hashes': message_id_hashes(ids),
+            'names': names.get_ids([x[0] for x in values]),
+            'emails': emails.get_ids([x[1] for x in values]),
+            'dates': np.fromiter((x[2] for x in values), dtype='<i8',
+                                 count=num),
+            'lists': MailMetadata._list_words(ids, list_table, get_lists),
+            'subjects': np.fromiter((subject_hash(x[3]) for x in values),
+                                    dtype='<u8', count=num),
+            'versions': np.array([x[0] for x in patches], dtype='<i4'),
+            'numbers': np.array([x[1] for x in patches], dtype='<i4'),
+            'totals': np.array([x[2] for x in patches], dtype='<i4'),
+        }
+
+    @staticmethod
+    def _list_words(ids, list_table, get_lists):
+        rows = list()
+        for message_id in ids:
+            rows.append([list_table.get_id(x)
+                         for x in sorted(get_lists(message_id))])
+
+        words = np.zeros((len(ids), (len(list_table.strings) + 63) // 64),
+                         dtype='<u8')
+        for row, lists in enumerate(rows):
+            for id in lists:
+                words[row, id // 64] |= np.uint64(1 << (id % 64))
+        return words
+
+    @staticmethod
+    def _widen(lists, words):
+        if lists.shape[1] == words:
+            return lists
+        return np.hstack((lists, np.zeros((len(lists),
+                                           words - lists.shape[1]),
+                                          dtype='<u8')))
+
+    @staticmethod
+    def _write(d_meta, columns, blob, tables):
+        # totals marks a complete table. It is removed first, so that an
+        # interrupted merge does not leave a mix of old and new columns
+        # behind that looks complete.
+        f_marker = os.path.join(d_meta, MailMetadata.COLUMNS[-1] + '.npy')
+        if os.path.isfile(f_marker):
+            os.remove(f_marker)
+
+        os.makedirs(d_meta, exist_ok=True)
+        for name, table in tables.items():
+            f_tmp = os.path.join(d_meta, name + '.tmp')
+            with open(f_tmp, 'w') as f:
+                f.write(''.join(['%s\n' % x for x in table.strings]))
+            os.replace(f_tmp, os.path.join(d_meta, name))
+
+        f_tmp = os.path.join(d_meta, 'ids.tmp')
+        with open(f_tmp, 'wb') as f:
+            f.write(blob)
+        os.replace(f_tmp, os.path.join(d_meta, 'ids'))
+
+        # totals is written last
+        for name in MailMetadata.COLUMNS:
+            f_tmp = os.path.join(d_meta, name + '.tmp.npy')
+            np.save(f_tmp, columns[name])
+            os.replace(f_tmp, os.path.join(d_meta, name + '.npy'))
+
+        return MailMetadata(d_meta)
+
+    @staticmethod
+    def _roots(hashes, offsets, blob, thread_index):
+        """
+        Returns the roots column: rows of the thread index and of the table
+        are matched by their hashes. Colliding hashes are resolved by their
+        Message-ID.
+        """
+        num = len(hashes)
+        roots = np.full(num, -1, dtype='<i4')
+        if not thread_index or not num or not thread_index.num:
+            return roots
+
+        def message_id(row):
+            return blob[int(offsets[row]):int(offsets[row + 1]) - 1]. \
+                decode('utf-8', 'surrogateescape')
+
+        def match(haystack, needles):
+            pos = np.searchsorted(haystack, needles)
+            valid = pos < len(haystack)
+            valid[valid] = haystack[pos[valid]] == needles[valid]
+            return np.where(valid, pos, -1)
+
+        thread_rows = match(thread_index.hashes, hashes)
+        collisions = np.flatnonzero(hashes[1:] == hashes[:-1])
+        for row in set(collisions.tolist()) | set((collisions + 1).tolist()):
+            found = thread_index.find(message_id(row))
+            thread_rows[row] = -1 if found is None else found
+
+        known = thread_rows != -1
+        root_rows = thread_index.roots[thread_rows[known]]
+        rows = match(hashes, thread_index.hashes[root_rows])
+        roots[known] = rows
+
+        # Roots with colliding hashes
+        if len(collisions):
+            ambiguous = np.isin(thread_index.hashes[root_rows],
+                                hashes[collisions])
+            for pos in np.flatnonzero(ambiguous).tolist():
+                root_id = thread_index.message_id(int(root_rows[pos]))
+                row = int(rows[pos])
+                while row < num and hashes[row] == hashes[rows[pos]]:
+                    if message_id(row) == root_id:
+                        break
+                    row += 1
+                roots[np.flatnonzero(known)[pos]] = row if row < num else -1
+
+        return roots
+
+    @staticmethod
+    def write(d_meta, mails, thread_index, get_lists):
+        """
+        Writes the metadata table
+
+        :param mails: dict of Message-ID -> (name, address, date, subject)
+        :param thread_index: ThreadIndex or None
+        :param get_lists: function that returns the lists of a Message-ID
+        """
+        ids = sorted(mails.keys(), key=message_id_hash)
+        tables = {name: StringTable() for name in MailMetadata.TABLES}
+
+        columns = MailMetadata._columns(mails, ids, tables['name_table'],
+                                        tables['email_table'],
+                                        tables['list_table'], get_lists)
+        blob, columns['offsets'] = encode_ids(ids)
+        columns['roots'] = MailMetadata._roots(columns['hashes'],
+                                               columns['offsets'], blob,
+                                               thread_index)
+
+        return MailMetadata._write(d_meta, columns, blob, tables)
+
+    def merge(self, mails, thread_index, get_lists, refresh=()):
+        """
+        Merges new mails into the table. Existing rows are not decoded.
+
+        :param mails: dict of new Message-IDs -> (name, address, date,
+                      subject)
+        :param refresh: Message-IDs of existing mails, whose lists are
+                        updated
+        :return: the merged table
+        """
+        tables = {name: StringTable(self._table(name))
+                  for name in MailMetadata.TABLES}
+
+        ids = sorted([x for x in mails if x not in self], key=message_id_hash)
+        new = MailMetadata._columns(mails, ids, tables['name_table'],
+                                    tables['email_table'],
+                                    tables['list_table'], get_lists)
+
+        positions = np.searchsorted(self.hashes, new['hashes'], side='right')
+        old_rows, _ = insert_rows(len(self), positions)
+
+        blob = self.mm[:] if self.mm else b''
+        blob, offsets = splice_ids(blob, self.offsets, positions, ids)
+
+        words = (len(tables['list_table'].strings) + 63) // 64
+        columns = {'offsets': offsets}
+        for name in MailMetadata.COLUMNS:
+            if name in ['offsets', 'roots']:
+                continue
+            column = getattr(self, name)
+            if name == 'lists':
+                column = MailMetadata._widen(column, words)
+                new[name] = MailMetadata._widen(new[name], words)
+            columns[name] = np.insert(column, positions, new[name], axis=0)
+
+        refresh = [self.find(x) for x in refresh]
+        refresh = [int(old_rows[x]) for x in refresh if x is not None]
+        if refresh:
+            ids = [blob[int(offsets[x]):int(offsets[x + 1]) - 1].decode(
+                'utf-8', 'surrogateescape') for x in refresh]
+            lists = MailMetadata._list_words(ids, tables['list_table'],
+                                             get_lists)
+            words = lists.shape[1]
+            columns['lists'] = MailMetadata._widen(columns['lists'], words)
+            columns['lists'][refresh] = lists
+
+        columns['roots'] = MailMetadata._roots(columns['hashes'], offsets,
+                                               blob, thread_index)
+
+        return MailMetadata._write(self.d_meta, columns, blob, tables)
+
+    def _table(self, name):
+        if name not in self._tables:
+            with open(os.path.join(self.d_meta, name), 'r') as f:
+                # Entries are '\n'-terminated. In contrast to splitlines(),
+                # this does not split at other line boundaries.
+                self._tables[name] = f.read().split('\n')[:-1]
+        return self._tables[name]
+
+    def message_id(self, row):
+        start = int(self.offsets[row])
+        end = int(self.offsets[row + 1]) - 1
+        return self.mm[start:end].decode('utf-8', 'surrogateescape')
+
+    def get_message_ids(self, rows=None):
+        if rows is None:
+            rows = np.arange(len(self))
+        elif rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        return [self.message_id(row) for row in rows.tolist()]
+
+    def get_names(self):
+        return self._table('name_table')
+
+    def get_emails(self):
+        return self._table('email_table')
+
+    def get_lists(self):
+        return self._table('list_table')
+
+    def find(self, message_id):
+        """
+        Returns the row of message_id, or None if it is not part of the table
+        """
+        hash = np.uint64(message_id_hash(message_id))
+        row = int(np.searchsorted(self.hashes, hash))
+
+        # Respect hash collisions
+        while row < len(self.hashes) and self.hashes[row] == hash:
+            if self.message_id(row) == message_id:
+                return row
+            row += 1
+
+        return None
+
+    def list_mask(self, listnames):
+        """
+        Returns the membership words of a set of lists
+        """
+        table = self.get_lists()
+        mask = np.zeros(self.lists.shape[1], dtype='<u8')
+        for listname in listnames:
+            if listname in table:
+                id = table.index(listname)
+                mask[id // 64] |= np.uint64(1 << (id % 64))
+        return mask
+
+    def get_lists_of_row(self, row):
+        table = self.get_lists()
+        words = self.lists[row]
+        return [x for id, x in enumerate(table)
+                if int(words[id // 64]) & (1 << (id % 64))]
+
+    def select(self, time_window=None, lists=None):
+        """
+        Returns a boolean mask of all rows within time_window (a pair of
+        datetimes), that were sent to at least one of lists
+        """
+        selection = np.ones(len(self.hashes), dtype=bool)
+        if time_window:
+            lower, upper = [_timestamp(x) for x in time_window]
+            selection &= (self.dates >= lower) & (self.dates <= upper)
+        if lists:
+            selection &= ((self.lists & self.list_mask(lists)) != 0).any(
+                axis=1)
+        return selection
+
+    def __contains__(self, message_id):
+        return self.find(message_id) is not None
+
+    def __len__(self):
+        return len(self.hashes)
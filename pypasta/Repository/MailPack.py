@@ -0,0 +1,233 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2019
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import mmap
+import numpy as np
+import os
+import struct
+
+from logging import getLogger
+
+from .MessageIndex import message_id_hash
+
+log = getLogger(__name__[-15:])
+
+
+def _zstd():
+    # zstandard is only required for compressed packs
+    import zstandard
+    return zstandard
+
+
+class MailPack:
+    """
+    Append-only storage of raw mails. Mails are appended to segment files
+    (<d_pack>/<n>.seg) as records: the '\n'-terminated Message-ID, followed
+    by the mail, optionally as zstd-compressed frame. The offset index
+    (<d_pack>/index) contains one row per mail, sorted by the hash of the
+    Message-ID: hash, segment, offset of the record, length of the mail,
+    length of the Message-ID and flags. Reading a mail is a single pread().
+
+    Hash collisions are resolved by comparing the stored Message-ID.
+    """
+    MAGIC = b'PaStAPK1'
+    HEADER = struct.Struct('<8sQ')
+    ROW = np.dtype([('hash', '<u8'), ('segment', '<u4'), ('offset', '<u8'),
+                    ('length', '<u4'), ('id_length', '<u2'),
+                    ('flags', 'u1')])
+    SEGMENT_SIZE = 1 << 30
+    FLAG_ZSTD = 1
+
+    def __init__(self, d_pack):
+        self.d_pack = d_pack
+        self.f_index = os.path.join(d_pack, 'index')
+        self.fds = dict()
+        self._decompressor = None
+        self._load()
+
+    @staticmethod
+    def exists(d_pack):
+        return os.path.isfile(os.path.join(d_pack, 'index'))
+
+    def _load(self):
+        self.mm = None
+        if not os.path.isfile(self.f_index):
+            self.rows = np.zeros(0, dtype=MailPack.ROW)
+            return
+
+        with open(self.f_index, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, num = MailPack.HEADER.unpack_from(self.mm)
+        if magic != MailPack.MAGIC:
+            raise ValueError('Invalid mail pack: %s' % self.d_pack)
+
+        self.rows = np.frombuffer(self.mm, dtype=MailPack.ROW, count=num,
+                                  offset=MailPack.HEADER.size)
+
+    def _segment(self, segment):
+        return os.path.join(self.d_pack, '%u.seg' % segment)
+
+    def _fd(self, segment):
+        fd = self.fds.get(segment)
+        if fd is None:
+            fd = self.fds[segment] = os.open(self._segment(segment),
+                                             os.O_RDONLY)
+        return fd
+
+    @staticmethod
+    def _encode_id(message_id):
+        return message_id.encode('utf-8', 'surrogateescape')
+
+    def _read(self, pos, with_mail=True):
+        """
+        Returns the encoded Message-ID and, optionally, the mail of a row
+        """
+        row = self.rows[pos]
+        id_length = int(row['id_length'])
+        length = id_length + 1
+        if with_mail:
+            length += int(row['length'])
+
+        record = os.pread(self._fd(int(row['segment'])), length,
+                          int(row['offset']))
+        return record[:id_length], record[id_length + 1:]
+
+    def _find(self, message_id, with_mail=False):
+        """
+        Returns the position of message_id in the index and, optionally, its
+        mail, or (None, None) if it is not packed
+        """
+        hashes = self.rows['hash']
+        hash = np.uint64(message_id_hash(message_id))
+        encoded = MailPack._encode_id(message_id)
+
+        # Respect hash collisions
+        pos = int(np.searchsorted(hashes, hash))
+        while pos < len(hashes) and hashes[pos] == hash:
+            stored, mail = self._read(pos, with_mail)
+            if stored == encoded:
+                return pos, mail
+            pos += 1
+
+        return None, None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, message_id):
+        return self._find(message_id)[0] is not None
+
+    def get_location(self, message_id):
+        """
+        Returns the (segment, offset) of a mail, or None if it is not packed
+        """
+        pos, _ = self._find(message_id)
+        if pos is None:
+            return None
+
+        row = self.rows[pos]
+        return int(row['segment']), int(row['offset'])
+
+    def __getitem__(self, message_id):
+        pos, raw = self._find(message_id, with_mail=True)
+        if pos is None:
+            raise KeyError(message_id)
+
+        if self.rows[pos]['flags'] & MailPack.FLAG_ZSTD:
+            if not self._decompressor:
+                self._decompressor = _zstd().ZstdDecompressor()
+            raw = self._decompressor.decompress(raw)
+
+        return raw
+
+    def is_compressed(self):
+        """
+        Returns True, if mails of the pack are stored as zstd frames
+        """
+        return bool((self.rows['flags'] & MailPack.FLAG_ZSTD).any())
+
+    def add(self, mails, compress=None):
+        """
+        Appends mails to the pack. Mails that are already part of the pack are
+        skipped.
+
+        :param mails: iterable of (message_id, raw) tuples
+        :param compress: store mails as zstd frames. Defaults to the mode of
+                         the pack.
+        :return: number of added mails
+        """
+        if compress is None:
+            compress = self.is_compressed()
+        compressor = _zstd().ZstdCompressor() if compress else None
+        flags = MailPack.FLAG_ZSTD if compress else 0
+
+        os.makedirs(self.d_pack, exist_ok=True)
+        segment = 0
+        if len(self.rows):
+            segment = int(self.rows['segment'].max())
+
+        seen = set()
+        rows = list()
+        f = open(self._segment(segment), 'ab')
+        try:
+            for message_id, raw in mails:
+                if message_id in seen or message_id in self:
+                    continue
+                seen.add(message_id)
+
+                if compressor:
+                    raw = compressor.compress(raw)
+
+                encoded = MailPack._encode_id(message_id)
+                record = len(encoded) + 1 + len(raw)
+                offset = f.tell()
+                if offset and offset + record > MailPack.SEGMENT_SIZE:
+                    f.close()
+                    segment += 1
+                    f = open(self._segment(segment), 'ab')
+                    offset = f.tell()
+
+                f.write(encoded + b'\n')
+                f.write(raw)
+                rows.append((message_id_hash(message_id), segment, offset,
+                             len(raw), len(encoded), flags))
+        finally:
+            f.close()
+
+        if rows:
+            self._write_index(np.concatenate(
+                (self.rows, np.array(rows, dtype=MailPack.ROW))))
+
+        return len(rows)
+
+    def _write_index(self, rows):
+        rows = rows[np.argsort(rows['hash'], kind='stable')]
+
+        f_tmp = self.f_index + '.tmp'
+        with open(f_tmp, 'wb') as f:
+            f.write(MailPack.HEADER.pack(MailPack.MAGIC, len(rows)))
+            f.write(rows.tobytes())
+        os.replace(f_tmp, self.f_index)
+
+        self._load()
+
+    def reopen(self):
+        """
+        Drops file descriptors, e.g., the ones inherited by worker processes
+        """
+        self.fds = dict()
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = dict()
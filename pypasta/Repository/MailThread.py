@@ -13,165 +13,525 @@ the COPYING file in the top-level directory.
 import os
 import pickle
 import re
+import shutil
 
-from email.header import Header
-from anytree import Node, RenderTree
-from itertools import chain
+from anytree import Node
 from logging import getLogger
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
 
+from .MailCache import reopen_containers, shard_batches
+from .MailMetadata import MailMetadata, journal_line, load_journal, \
+    parse_journal_line
+from .PatchSeries import SeriesIndex
+from .ThreadIndex import ThreadIndex
+
 log = getLogger(__name__[-15:])
 
 ID_REGEX = re.compile(r'(<\S+>)')
 _mbox = None
 
 
-def sanitise_header(message, header):
-    contents = message.get_all(header)
+def sanitise_header(headers, header):
+    contents = headers.get_all(header)
     ids = set()
 
     if not contents:
         return ids
 
     for content in contents:
-        # special treatment for mails with unknown encoding in their headers
-        if isinstance(content, Header):
-            content = bytearray(content._chunks[0][0], 'utf-8',
-                                'ignore').decode()
-
         ids |= set(ID_REGEX.findall(content))
 
     return ids
 
 
+def ordered_ids(headers, header):
+    """
+    Returns the ids of all header lines of header in their order of
+    appearance, without duplicates
+    """
+    ids = list()
+    for content in headers.get_all(header) or []:
+        for id in ID_REGEX.findall(content):
+            if id not in ids:
+                ids.append(id)
+
+    return ids
+
+
 def get_irts(id):
-    messages = _mbox.get_messages(id)
-    ret = None
+    """
+    Returns a compact (id, in-reply-to ids, referenced ids, metadata journal
+    line) tuple of a mail. Identical copies of the mail are parsed once.
+    References keep the order of the header.
+    """
     irt = set()
     ids = set()
-
-    for message in messages:
-        irt |= sanitise_header(message, 'in-reply-to')
-        ids |= sanitise_header(message, 'message-id')
+    references = list()
+    from_header = date = subject = None
+
+    for headers in _mbox.get_headers(id):
+        irt |= sanitise_header(headers, 'in-reply-to')
+        ids |= sanitise_header(headers, 'message-id')
+        references += [x for x in ordered_ids(headers, 'references')
+                       if x not in references]
+        from_header = from_header or headers['From']
+        date = date or headers['Date']
+        subject = subject or headers['Subject']
 
     irt -= ids
+    references = [x for x in references if x not in ids]
+
+    return id, tuple(sorted(irt)), tuple(references), \
+           journal_line(id, from_header, date, subject)
+
 
-    if len(irt):
-        ret = set(irt)
+def _get_irts_batch(args):
+    source, ids = args
+    return [get_irts(id) for id in ids]
 
-    return id, ret
+
+def _init_worker():
+    reopen_containers(_mbox)
 
 
 class MailThread:
+    """
+    Thread cache of all mails. The cache is an append-only journal with one
+    line per processed mail: its Message-ID, its In-Reply-To mails and its
+    References (tab-separated). Updates only process mails that were ingested
+    since the last update, and merge them into the thread index, the metadata
+    table and the series index.
+
+    Mails that refer to mails that are not (yet) known are kept in the
+    orphans file, in the format of the journal. Once the missing mails
+    arrive, their parents are determined again.
+    """
+    # Former caches were pickled MailThread objects
+    PICKLE_MAGIC = b'\x80'
+    BATCHSIZE = 1000
+    ORPHANS_SUFFIX = '.orphans'
+
     def __init__(self, mbox, f_cache):
         self.f_cache = f_cache
         self.reply_to_map = dict()
         self.parents = set()
+        # References of mails, used if no In-Reply-To mail exists
+        self.references = dict()
+        # All mails that are part of the cache
+        self.processed = set()
+        self._journal_loaded = False
         self.mbox = mbox
+        self.index = None
+        self.series = None
+        self.metadata = None
+        self.f_meta = f_cache + MailMetadata.JOURNAL_SUFFIX
+        self.f_orphans = f_cache + MailThread.ORPHANS_SUFFIX
+
+    def _add(self, id, irts, references):
+        self.processed.add(id)
+        self.references[id] = references
+
+        # If there are no In-Reply-To headers, then the mail is the parent
+        # of a thread.
+        if not irts:
+            self.parents.add(id)
+            return
 
-    def update(self, parallelise=True):
-        log.info('Updating mail thread cache')
-        all_messages = self.mbox.message_ids(allow_invalid=True)
-        present = set(chain.from_iterable(self.reply_to_map.values()))
-        victims = all_messages - present - self.parents
-        length = len(victims)
-        if len(victims) == 0:
-            log.info('Cache is already up to date')
+        # Otherwise, let the father point to his children
+        for irt in irts:
+            if irt not in self.reply_to_map:
+                self.reply_to_map[irt] = set()
+            self.reply_to_map[irt].add(id)
+
+    @staticmethod
+    def _journal_line(id, irts, references):
+        return '%s\t%s\t%s\n' % (id, ' '.join(sorted(irts or [])),
+                                  ' '.join(references or []))
+
+    @staticmethod
+    def _read_journal(filename):
+        if not os.path.isfile(filename):
             return
+        with open(filename, 'r') as f:
+            for line in f:
+                id, irts, references = line.rstrip('\n').split('\t')
+                yield id, set(irts.split()), tuple(references.split())
+
+    def _load_journal(self):
+        # The journal is only required for full rebuilds and for mails that
+        # are not part of the index
+        if self._journal_loaded:
+            return
+        self._journal_loaded = True
+        for id, irts, references in MailThread._read_journal(self.f_cache):
+            self._add(id, irts, references)
+
+    def _migrate_pickle(self):
+        log.info('Migrating mail thread cache to journal...')
+        with open(self.f_cache, 'rb') as f:
+            old = pickle.load(f)
+
+        in_reply_to = dict()
+        for irt, responses in old.reply_to_map.items():
+            for response in responses:
+                in_reply_to.setdefault(response, set()).add(irt)
+        references = getattr(old, 'references', dict())
+
+        f_tmp = self.f_cache + '.tmp'
+        with open(f_tmp, 'w') as f:
+            for id in old.parents:
+                f.write(MailThread._journal_line(
+                    id, None, sorted(references.get(id, []))))
+            for id, irts in in_reply_to.items():
+                f.write(MailThread._journal_line(
+                    id, irts, sorted(references.get(id, []))))
+        os.replace(f_tmp, self.f_cache)
+
+        # Indexes of the pickled cache are stale, update() rebuilds them
+        for suffix in [ThreadIndex.SUFFIX, SeriesIndex.SUFFIX,
+                       MailThread.ORPHANS_SUFFIX]:
+            if os.path.isfile(self.f_cache + suffix):
+                os.remove(self.f_cache + suffix)
 
+    @staticmethod
+    def _choose_parent(irts, references, known):
+        """
+        Returns the parent of a mail: its In-Reply-To mail, or, if no
+        In-Reply-To mail exists, the last mail of its References, which is
+        its direct parent (RFC 5322). Only known mails are considered.
+        """
+        candidates = [x for x in irts if known(x)]
+        if candidates:
+            return min(candidates)
+
+        for reference in reversed(references):
+            if known(reference):
+                return reference
+        return None
+
+    def _write_orphans(self, orphans):
+        f_tmp = self.f_orphans + '.tmp'
+        with open(f_tmp, 'w') as f:
+            for id, (irts, references) in sorted(orphans.items()):
+                f.write(MailThread._journal_line(id, irts, references))
+        os.replace(f_tmp, self.f_orphans)
+
+    def _process(self, victims, parallelise, is_processed):
+        """
+        Parses the headers of victims and appends them to the journals.
+
+        :return: tuple of (dict of new Message-IDs -> (irts, references),
+                 dict of new Message-IDs -> metadata)
+        """
+        length = len(victims)
         log.info('Creating caches for %d mails' % length)
 
+        # Batches of mails of one shard, in the order of their blobs
+        batches, missing = shard_batches(self.mbox, victims,
+                                         MailThread.BATCHSIZE)
+        batches.append((None, missing))
+
         global _mbox
         _mbox = self.mbox
 
-        if parallelise:
-            with Pool(cpu_count()) as p:
-                irt_list = list(tqdm(p.imap(get_irts, victims), total=length))
-        else:
-            irt_list = list(tqdm(map(get_irts, victims), total=length))
-
-        _mbox = None
-
-        for id, irts in tqdm(irt_list):
-            # If there are no In-Reply-To headers, then the mail is the parent
-            # of a thread.
-            if not irts:
-                self.parents.add(id)
-                continue
-
-            # Otherwise, let the father point to his children
-            for irt in irts:
-                if irt not in self.reply_to_map:
-                    self.reply_to_map[irt] = set()
-                self.reply_to_map[irt].add(id)
+        new = dict()
+        meta = dict()
+        p = None
+        try:
+            if parallelise:
+                p = Pool(cpu_count(), initializer=_init_worker)
+                results = p.imap_unordered(_get_irts_batch, batches)
+            else:
+                results = map(_get_irts_batch, batches)
+
+            with open(self.f_cache, 'a') as f, \
+                 open(self.f_meta, 'a') as f_meta, \
+                 tqdm(total=length) as progress:
+                for result in results:
+                    for id, irts, references, meta_line in result:
+                        f_meta.write(meta_line)
+                        if is_processed(id):
+                            continue
+                        meta[id] = parse_journal_line(meta_line)[1]
+                        new[id] = irts, references
+                        f.write(MailThread._journal_line(id, irts,
+                                                         references))
+                    progress.update(len(result))
+        finally:
+            # Do not leak workers if a batch or the journal fails
+            if p:
+                p.close()
+                p.join()
+            _mbox = None
 
-        log.info('Writing mailbox thread cache...')
-        _mbox = self.mbox
-        self.mbox = None
-        pickle.dump(self, open(self.f_cache, 'wb'))
-        self.mbox = _mbox
-        _mbox = None
         log.info('  ↪ done')
+        return new, meta
+
+    def update(self, parallelise=True):
+        log.info('Updating mail thread cache')
 
-    def _get_thread(self, node, visited):
-        this_id = node.name
+        pending = self.mbox.get_pending()
+        if pending is None or not self.index or not self.metadata or \
+           not os.path.isfile(self.f_orphans):
+            self._update_all(pending, parallelise)
+            return
 
-        # visited tracks visited mails, used to eliminate cycles
-        visited.add(this_id)
+        # Mails that are already indexed were ingested from other lists
+        victims = {x for x in pending if x not in self.index}
+        refresh = pending - victims
 
-        if this_id not in self.reply_to_map:
+        if len(pending) == 0:
+            log.info('Cache is already up to date')
+            self.mbox.clear_pending()
+            if not self.series:
+                self.series = SeriesIndex.write(self.f_cache +
+                                                SeriesIndex.SUFFIX,
+                                                self.metadata)
             return
-        responses = self.reply_to_map[this_id]
 
-        for response in responses:
-            if response in visited:
-                continue
+        new = meta = dict()
+        if victims:
+            new, meta = self._process(victims, parallelise,
+                                      lambda id: id in self.index)
+
+        def known(id):
+            return id in new or id in self.index
+
+        parents = dict()
+        orphans = dict()
+        for id, (irts, references) in new.items():
+            parents[id] = MailThread._choose_parent(irts, references, known)
+            if not all(map(known, irts)) or not all(map(known, references)):
+                orphans[id] = irts, references
+
+        # Determine parents of orphans again, if missing mails arrived
+        reparent = dict()
+        for id, irts, references in MailThread._read_journal(self.f_orphans):
+            parent = MailThread._choose_parent(irts, references, known)
+            if parent != self.index.get_parent(id):
+                reparent[id] = parent
+            if not all(map(known, irts)) or not all(map(known, references)):
+                orphans[id] = irts, references
+
+        log.info('Merging %d mails into the mail thread index...' %
+                 len(parents))
+        self.index = self.index.merge(parents, reparent)
+        self._write_orphans(orphans)
+        log.info('  ↪ done: %d mails, %d re-parented' %
+                 (len(self.index), len(reparent)))
+
+        log.info('Merging mail metadata table...')
+        self.metadata = self.metadata.merge(meta, self.index,
+                                            self.mbox.get_lists, refresh)
+        log.info('  ↪ done: %d mails, %d authors' %
+                 (len(self.metadata), len(self.metadata.get_emails())))
+
+        self._write_series()
+        self.mbox.clear_pending()
+
+    def _update_all(self, pending, parallelise):
+        self._load_journal()
+
+        # Without knowledge of newly ingested mails, compare against all mails
+        all_messages = None
+        if pending is None or not self.processed:
+            all_messages = self.mbox.message_ids(allow_invalid=True)
+            pending = all_messages
+        victims = pending - self.processed
+
+        # The metadata journal needs the headers of all mails once
+        if not os.path.isfile(self.f_meta):
+            victims |= self.processed
 
-            child = Node(response, parent=node)
-            if response not in self.reply_to_map:
+        if len(victims) == 0:
+            log.info('Cache is already up to date')
+        else:
+            new, _ = self._process(victims, parallelise,
+                                   lambda id: id in self.processed)
+            for id, (irts, references) in new.items():
+                self._add(id, irts, references)
+
+        self.mbox.clear_pending()
+        self.write_index(all_messages)
+
+    def _write_series(self):
+        log.info('Writing patch series index...')
+        self.series = SeriesIndex.write(self.f_cache + SeriesIndex.SUFFIX,
+                                        self.metadata)
+        log.info('  ↪ done: %d series' % len(self.series))
+
+    def write_index(self, all_messages=None):
+        """
+        Writes the thread index, the metadata table and the series index from
+        scratch. The parent of a mail is its In-Reply-To mail, or, if no
+        In-Reply-To mail exists, the last mail that it references. Only existing
+        mails are considered.
+        """
+        self._load_journal()
+
+        log.info('Writing mail thread index...')
+        if all_messages is None:
+            all_messages = self.mbox.message_ids(allow_invalid=True)
+        parents = {id: None for id in all_messages}
+
+        in_reply_to = dict()
+        for irt, responses in self.reply_to_map.items():
+            for response in responses:
+                in_reply_to.setdefault(response, set()).add(irt)
+
+        orphans = dict()
+        known = parents.__contains__
+        for id in parents:
+            irts = in_reply_to.get(id, set())
+            references = self.references.get(id, ())
+            parents[id] = MailThread._choose_parent(irts, references, known)
+            if not all(map(known, irts)) or not all(map(known, references)):
+                orphans[id] = irts, references
+
+        self.index = ThreadIndex.write(self.f_cache + ThreadIndex.SUFFIX,
+                                       parents)
+        self._write_orphans(orphans)
+        log.info('  ↪ done: %d mails' % len(self.index))
+
+        log.info('Writing mail metadata table...')
+        self.metadata = MailMetadata.write(self.f_cache + MailMetadata.SUFFIX,
+                                           load_journal(self.f_meta),
+                                           self.index, self.mbox.get_lists)
+        log.info('  ↪ done: %d mails, %d authors' %
+                 (len(self.metadata), len(self.metadata.get_emails())))
+
+        self._write_series()
+
+    def walk(self, message_id, max_depth=None, max_size=None):
+        """
+        Iteratively walks the thread below message_id in pre-order, and
+        yields a (message_id, depth, parent) tuple for each mail. The parent
+        of message_id is None. Each mail is visited once, so reference loops
+        terminate.
+
+        :param max_depth: do not descend below this depth
+        :param max_size: stop after this number of mails
+        """
+        # Walk on rows of the index, if possible. The index has no cycles.
+        start = self.index.find(message_id) if self.index else None
+        if start is None:
+            self._load_journal()
+            start = message_id
+            get_id = str
+            get_children = lambda id: sorted(self.reply_to_map.get(id, []))
+        else:
+            get_id = self.index.message_id
+            get_children = self.index.get_children
+
+        visited = {start}
+        stack = [(start, 0, None)]
+        size = 0
+        while stack:
+            node, depth, parent = stack.pop()
+            id = get_id(node)
+            yield id, depth, parent
+
+            size += 1
+            if max_size is not None and size >= max_size:
+                return
+            if max_depth is not None and depth >= max_depth:
                 continue
-            self._get_thread(child, visited)
 
-    def pretty_print(self, thread):
-        for pre, fill, node in RenderTree(thread):
-            message = self.mbox.get_messages(node.name)[0]
-            print("%.20s\t\t%s%s" % (message['From'], pre, node.name))
+            children = [child for child in get_children(node)
+                        if child not in visited]
+            visited.update(children)
+            stack += [(child, depth + 1, id) for child in reversed(children)]
+
+    def pretty_print(self, message_id, max_depth=None):
+        for id, depth, _ in self.walk(self.get_parent(message_id),
+                                      max_depth=max_depth):
+            headers = self.mbox.get_headers(id)[0]
+            print("%.20s\t\t%s%s" % (headers['From'], '  ' * depth, id))
+
+    def get_parent(self, message_id, visited=None):
+        """
+        Returns the root of the thread of message_id
+        """
+        if self.index:
+            root = self.index.get_root(message_id)
+            if root:
+                return root
 
-    def get_parent(self, message_id, visited):
         # visited tracks visited mails, used to eliminate cycles
-        visited.add(message_id)
-        # FIXME respect non-unique message ids
-        message = self.mbox.get_messages(message_id)[0]
-        if message is None:
-            return message_id
-
-        # get the parent message-id by walking up references an in-reply-to
-        # header. Remove the own message it, as it must not be a reference.
-        references = sanitise_header(message, 'references') | \
-                     sanitise_header(message, 'in-reply-to')
-        references.discard(message_id)
-        if not references:
-            return message_id
-
-        for reference in references:
-            if reference in self.mbox and reference not in visited:
-                return self.get_parent(reference, visited)
-        return message_id
-
-    def get_thread(self, message_id):
-        parent = self.get_parent(message_id, set())
-        head = Node(parent)
-        self._get_thread(head, set())
+        if visited is None:
+            visited = set()
+
+        while True:
+            visited.add(message_id)
+            # FIXME respect non-unique message ids
+            headers = self.mbox.get_headers(message_id)[0]
+            if headers is None:
+                return message_id
+
+            # get the parent message-id by walking up references an
+            # in-reply-to header. Remove the own message it, as it must not be
+            # a reference.
+            references = sanitise_header(headers, 'references') | \
+                         sanitise_header(headers, 'in-reply-to')
+            references.discard(message_id)
+
+            parent = None
+            for reference in sorted(references):
+                if reference in self.mbox and reference not in visited:
+                    parent = reference
+                    break
+
+            if parent is None:
+                return message_id
+            message_id = parent
+
+    def get_thread(self, message_id, max_depth=None, max_size=None):
+        """
+        Returns the thread of message_id as tree of anytree Nodes. Prefer
+        walk() if the tree is not required.
+        """
+        nodes = dict()
+        head = None
+        for id, _, parent in self.walk(self.get_parent(message_id),
+                                       max_depth=max_depth,
+                                       max_size=max_size):
+            node = Node(id, parent=nodes.get(parent))
+            nodes[id] = node
+            head = head or node
+
         return head
 
     @staticmethod
     def load(filename, mbox):
-        if os.path.isfile(filename):
-            with open(filename, 'rb') as f:
-                mailthreads = pickle.load(f)
-            mailthreads.mbox = mbox
-            mailthreads.f_cache = filename
+        mailthreads = MailThread(mbox, filename)
+        if not os.path.isfile(filename):
+            log.warning('MailThread cache not existing')
             return mailthreads
-        log.warning('MailThread cache not existing')
-        return MailThread(mbox, filename)
+
+        with open(filename, 'rb') as f:
+            is_pickle = f.read(1) == MailThread.PICKLE_MAGIC
+        if is_pickle:
+            mailthreads._migrate_pickle()
+
+        mailthreads.index = ThreadIndex.load(filename + ThreadIndex.SUFFIX)
+        mailthreads.metadata = MailMetadata.load(filename +
+                                                 MailMetadata.SUFFIX)
+        mailthreads.series = SeriesIndex.load(filename + SeriesIndex.SUFFIX,
+                                              mailthreads.metadata)
+        return mailthreads
+
+    @staticmethod
+    def clear(filename):
+        """
+        Removes the cache and all files that are derived from it
+        """
+        for suffix in ['', ThreadIndex.SUFFIX, SeriesIndex.SUFFIX,
+                       MailMetadata.JOURNAL_SUFFIX,
+                       MailThread.ORPHANS_SUFFIX]:
+            if os.path.isfile(filename + suffix):
+                os.remove(filename + suffix)
+
+        d_meta = filename + MailMetadata.SUFFIX
+        if os.path.isdir(d_meta):
+            shutil.rmtree(d_meta)
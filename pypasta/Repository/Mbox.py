@@ -11,19 +11,24 @@ the COPYING file in the top-level directory.
 """
 
 import datetime
-import dateparser
 import email
 import git
-import glob
 import os
 import pygit2
 import re
 
+from collections import Counter
 from email.charset import CHARSETS
 from logging import getLogger
-from subprocess import call
+from multiprocessing import Pool, cpu_count
+from tqdm import tqdm
 
+from .MailHeaders import MailHeaders, log_date_stats, mail_parse_date, \
+    parse_date_stats
+from .MailIngest import ingest
+from .MailPack import MailPack
 from .MailThread import MailThread
+from .MessageIndex import InvalidLog, MessageIndex, MessageRouter
 from .MessageDiff import MessageDiff, Signature
 from ..Util import get_commit_hash_range
 
@@ -34,18 +39,9 @@ PATCH_SUBJECT_REGEX = re.compile(r'\[.*\]:? ?(.*)')
 DIFF_START_REGEX = re.compile(r'^--- \S+/.+$')
 ANNOTATION_REGEX = re.compile(r'^---\s*$')
 
-
-def mail_parse_date(date_str):
-    try:
-        date = email.utils.parsedate_to_datetime(date_str)
-    except Exception:
-        date = None
-    if not date:
-        try:
-            date = dateparser.parse(date_str)
-        except Exception:
-            date = None
-    return date
+# pygit2 repositories are not pickleable. Worker processes open repositories
+# of public inboxes on demand.
+_pub_in_repos = dict()
 
 
 class PatchMail(MessageDiff):
@@ -172,58 +168,69 @@ def parse_list(payload):
     return None
 
 
-def load_file(filename, must_exist=True):
-    if not os.path.isfile(filename) and must_exist is False:
-        return []
-
-    with open(filename) as f:
-        f = f.read().split('\n')
+def get_pub_in_blob(repo, commit):
+    blob = repo[commit].tree['m'].hex
+    return repo[blob].data
 
-    while len(f) and not f[-1]:
-        f.pop()
 
-    f = [tuple(x.split(' ')) for x in f]
-
-    return f
+class MailContainer:
+    """
+    Common base of mail containers. Subclasses provide get_indices(), which
+    returns the MessageIndex objects of the container.
+    """
+    def message_ids(self, time_window=None, allow_invalid=False):
+        ids = set()
+        for index in self.get_indices():
+            ids |= index.message_ids(time_window, allow_invalid)
+        return ids
 
+    def invalidate(self, hashes):
+        for index in self.get_indices():
+            index.invalidate(hashes)
 
-def load_index(basename):
-    result = load_file(basename, must_exist=False)
+    def __contains__(self, message_id):
+        return any(message_id in index for index in self.get_indices())
 
-    return {message_id: (datetime.datetime.strptime(date, "%Y/%m/%d"), date,
-                         location)
-            for (date, message_id, location) in result}
+    def _reading_key(self, message_id):
+        for index in self.get_indices():
+            row = index.find(message_id)
+            if row is not None:
+                return 1, int(index.days[row]), 0
+        return 2, 0, 0
 
+    def reading_order(self, message_ids):
+        """
+        Sorts Message-IDs in the order that is best for reading their mails
+        """
+        return sorted(message_ids, key=self._reading_key)
 
-class MailContainer:
-    def message_ids(self, time_window=None):
-        if time_window:
-            return {x[0] for x in self.index.items()
-                    if time_window[0] <= x[1][0] <= time_window[1]}
-
-        return set(self.index.keys())
-
-    def __contains__(self, message_id):
-        return message_id in self.index
+    def reopen(self):
+        """
+        Reopens handles, e.g., in worker processes
+        """
+        pass
 
 
 class PubInbox(MailContainer):
     MESSAGE_ID_REGEX = re.compile(r'.*(<.*>).*')
+    # Size of a commit OID in bytes
+    OID_SIZE = 20
 
     def __init__(self, listname, d_repo, f_index):
         self.listname = listname
         self.f_index = f_index
         self.d_repo = d_repo
 
+        self.f_head = f_index + '.head'
+
         self.repo = pygit2.Repository(d_repo)
-        self.index = load_index(self.f_index)
+        self.index = MessageIndex.load(self.f_index, PubInbox.OID_SIZE)
 
         log.info('  ↪ loaded mail index for %s: found %d mails' %
                  (listname, len(self.index)))
 
     def get_blob(self, commit):
-        blob = self.repo[commit].tree['m'].hex
-        return self.repo[blob].data
+        return get_pub_in_blob(self.repo, commit)
 
     def get_mail_by_commit(self, commit):
         return email.message_from_bytes(self.get_blob(commit))
@@ -233,127 +240,314 @@ class PubInbox(MailContainer):
         return self.get_mail_by_commit(commit)
 
     def get_hash(self, message_id):
-        return self.index[message_id][2]
+        return self.index.get_location(message_id)
+
+    def get_indices(self):
+        return [self.index]
 
     def __getitem__(self, message_id):
         commit = self.get_hash(message_id)
         return self.get_blob(commit)
 
-    def update(self):
+    def reopen(self):
+        self.repo = pygit2.Repository(self.d_repo)
+
+    def fetch(self):
         log.info('Update list %s' % self.listname)
         repo = git.Repo(self.d_repo)
         for remote in repo.remotes:
             remote.fetch()
         self.repo = pygit2.Repository(self.d_repo)
 
-        known_hashes = {hash for (_, _, hash) in self.index.values()}
-        hashes = set(get_commit_hash_range(self.d_repo, 'origin/master'))
+    def get_new_hashes(self):
+        """
+        Returns the head of the inbox and all commits that were added since
+        the last update, oldest first.
+        """
+        head = git.Repo(self.d_repo).git.rev_parse('origin/master')
 
-        hashes = hashes - known_hashes
-        log.info('Updating %d emails' % len(hashes))
+        last_head = None
+        if os.path.isfile(self.f_head):
+            with open(self.f_head, 'r') as f:
+                last_head = f.read().strip()
 
-        for hash in hashes:
-            mail = self.get_mail_by_commit(hash)
-            if not mail['Message-ID']:
-                log.warning('No Message ID in commit %s' % hash)
-                continue
-            message_id = mail['Message-ID'].replace(' ', '').strip()
-            match = PubInbox.MESSAGE_ID_REGEX.match(message_id)
-            if not match:
-                log.warning('Unable to parse Message ID: %s' % message_id)
+        if last_head:
+            try:
+                hashes = get_commit_hash_range(self.d_repo, '%s..%s' %
+                                               (last_head, head))
+                return head, list(reversed(hashes))
+            except git.GitCommandError:
+                log.warning('Unable to find last head of %s' % self.listname)
+
+        known_hashes = self.index.get_locations()
+        hashes = get_commit_hash_range(self.d_repo, head)
+        return head, [x for x in reversed(hashes) if x not in known_hashes]
+
+    def add(self, head, parsed):
+        """
+        Appends parsed mails to the index
+
+        :param head: head of the inbox after the update
+        :param parsed: list of (hash, message_id, format_date, error) tuples
+        :return: set of added Message-IDs
+        """
+        new = dict()
+        for hash, message_id, format_date, error in parsed:
+            if error:
+                log.warning(error)
                 continue
 
-            message_id = match.group(1)
-
-            if message_id in self.index:
+            if message_id in self.index or message_id in new:
                 log.warning('Duplicate Message id %s. Skipping' % message_id)
                 continue
 
-            date = mail_parse_date(mail['Date'])
-            if not date:
-                log.warning('Unable to parse datetime %s of %s (%s)' %
-                            (mail['Date'], message_id, hash))
-                continue
+            new[message_id] = format_date, hash
+
+        entries = [(format_date, message_id, hash)
+                   for message_id, (format_date, hash) in new.items()]
+        if entries:
+            with open(self.f_index, 'a') as f:
+                f.write(''.join(['%s %s %s\n' % x for x in entries]))
+            self.index = self.index.append(entries)
+
+        with open(self.f_head, 'w') as f:
+            f.write('%s\n' % head)
+
+        return set(new.keys())
+
+    def update(self):
+        return update_public_inboxes([self])
+
+
+def _parse_pub_in_batch(args):
+    d_repo, hashes = args
 
-            format_date = date.strftime('%04Y/%m/%d')
+    repo = _pub_in_repos.get(d_repo)
+    if repo is None:
+        repo = _pub_in_repos[d_repo] = pygit2.Repository(d_repo)
 
-            self.index[message_id] = date, format_date, hash
+    parsed = [parse_pub_in_mail(hash, get_pub_in_blob(repo, hash))
+              for hash in hashes]
+    return parsed, parse_date_stats(reset=True)
 
-        with open(self.f_index, 'w') as f:
-            index = ['%s %s %s' % (format_date, message_id, commit)
-                     for (message_id, (date, format_date, commit))
-                     in self.index.items()]
-            index.sort()
-            f.write('\n'.join(index) + '\n')
+
+def parse_pub_in_mail(hash, raw):
+    """
+    Extracts Message-ID and date of a mail of a public inbox. Only headers are
+    parsed.
+
+    :return: tuple of (hash, message_id, format_date, error)
+    """
+    mail = MailHeaders(raw)
+    if not mail['Message-ID']:
+        return hash, None, None, 'No Message ID in commit %s' % hash
+
+    message_id = mail['Message-ID'].replace(' ', '').strip()
+    match = PubInbox.MESSAGE_ID_REGEX.match(message_id)
+    if not match:
+        return hash, None, None, 'Unable to parse Message ID: %s' % message_id
+
+    message_id = match.group(1)
+
+    date = mail_parse_date(mail['Date'])
+    if not date:
+        return hash, None, None, 'Unable to parse datetime %s of %s (%s)' % \
+               (mail['Date'], message_id, hash)
+
+    return hash, message_id, date.strftime('%04Y/%m/%d'), None
+
+
+def update_public_inboxes(inboxes, parallelise=True):
+    """
+    Updates public inboxes. Mails of all shards are parsed in batches across
+    a pool of processes. Batches follow the history of a shard. Returns the
+    set of new Message-IDs.
+    """
+    batchsize = 1000
+    heads = dict()
+    worklist = list()
+
+    for inbox in inboxes:
+        inbox.fetch()
+        heads[inbox.d_repo], hashes = inbox.get_new_hashes()
+        log.info('  ↪ %s: %d new mails' % (inbox.listname, len(hashes)))
+        worklist += [(inbox.d_repo, hashes[i:i + batchsize])
+                     for i in range(0, len(hashes), batchsize)]
+
+    if parallelise and len(worklist) > 1:
+        with Pool(cpu_count()) as p:
+            results = list(tqdm(p.imap(_parse_pub_in_batch, worklist),
+                                total=len(worklist)))
+    else:
+        results = list(map(_parse_pub_in_batch, worklist))
+
+    parsed = {inbox.d_repo: list() for inbox in inboxes}
+    date_stats = Counter()
+    for (d_repo, _), (result, stats) in zip(worklist, results):
+        parsed[d_repo] += result
+        date_stats.update(stats)
+    log_date_stats(log, date_stats)
+
+    message_ids = set()
+    for inbox in inboxes:
+        message_ids |= inbox.add(heads[inbox.d_repo], parsed[inbox.d_repo])
+
+    return message_ids
 
 
 class MboxRaw(MailContainer):
+    # Size of the MD5 hash of a Message-ID in bytes
+    MD5_SIZE = 16
+
     def __init__(self, d_mbox, d_index):
         self.d_mbox = d_mbox
         self.d_mbox_raw = os.path.join(d_mbox, 'raw')
+        self.d_pack = os.path.join(d_mbox, 'pack')
         self.d_index = d_index
-        self.index = {}
-        self.lists = {}
+        self.indices = {}
+        self.packs = {}
         self.raw_mboxes = []
 
     def add_mbox(self, listname, f_mbox_raw):
         self.raw_mboxes.append((listname, f_mbox_raw))
         f_mbox_index = os.path.join(self.d_index, 'raw.%s' % listname)
-        index = load_index(f_mbox_index)
+        index = MessageIndex.load(f_mbox_index, MboxRaw.MD5_SIZE)
         log.info('  ↪ loaded mail index for %s: found %d mails' % (listname, len(index)))
-        self.index = {**self.index, **index}
-        return set(index.keys())
+        self.indices[listname] = index
+
+        d_pack = os.path.join(self.d_pack, listname)
+        if MailPack.exists(d_pack):
+            self.packs[listname] = MailPack(d_pack)
+            log.info('  ↪ loaded mail pack for %s: found %d mails' %
+                     (listname, len(self.packs[listname])))
+
+        return index
+
+    def get_indices(self):
+        return self.indices.values()
 
     def update(self):
+        message_ids = set()
         for listname, f_mbox_raw in self.raw_mboxes:
             if not os.path.exists(f_mbox_raw):
                 log.error('not a file or directory: %s' % f_mbox_raw)
                 quit(-1)
 
             log.info('Processing raw mailbox %s' % listname)
-            cwd = os.getcwd()
-            os.chdir(os.path.join(cwd, 'tools'))
-            ret = call(['./process_mailbox_maildir.sh', listname, self.d_mbox, f_mbox_raw])
-            os.chdir(cwd)
-            if ret == 0:
+            success, ingested = ingest(listname, self.d_mbox, f_mbox_raw,
+                                       pack=self.packs.get(listname))
+            message_ids |= ingested
+            if success:
                 log.info('  ↪ done')
             else:
                 log.error('Mail processor failed!')
 
-    def __getitem__(self, message_id):
-        _, date_str, md5 = self.index[message_id]
+        return message_ids
+
+    def pack(self, compress=None):
+        """
+        Converts the raw mail trees of all mailboxes to packs. Mails that are
+        already packed are skipped, the raw mail tree is left untouched.
+
+        :return: set of indexed Message-IDs without raw mail
+        """
+        missing = set()
+
+        def read_raws(index, message_ids):
+            for message_id in message_ids:
+                try:
+                    yield message_id, self._read_raw(index, message_id)
+                except FileNotFoundError:
+                    log.debug('Raw mail of %s is missing' % message_id)
+                    missing.add(message_id)
+
+        for listname, index in self.indices.items():
+            log.info('Packing raw mailbox %s' % listname)
+            pack = self.packs.get(listname)
+            if pack is None:
+                pack = MailPack(os.path.join(self.d_pack, listname))
+
+            num_missing = len(missing)
+            message_ids = [x for x in
+                           sorted(index.message_ids(allow_invalid=True))
+                           if x not in pack]
+            added = pack.add(read_raws(index, tqdm(message_ids)), compress)
+            self.packs[listname] = pack
+            log.info('  ↪ packed %d mails' % added)
+            if len(missing) > num_missing:
+                log.warning('  ↪ skipped %d mails without raw mail' %
+                            (len(missing) - num_missing))
+
+        return missing
+
+    def _read_raw(self, index, message_id):
+        date_str = index.get_date(message_id).strftime('%Y/%m/%d')
+        md5 = index.get_location(message_id)
         filename = os.path.join(self.d_mbox_raw, date_str, md5)
         with open(filename, 'rb') as f:
             return f.read()
 
+    def reopen(self):
+        for pack in self.packs.values():
+            pack.reopen()
+
+    def _reading_key(self, message_id):
+        # Packed mails are read in the order of the pack
+        for listname, pack in self.packs.items():
+            location = pack.get_location(message_id)
+            if location is not None:
+                return (0,) + location
+        return super(MboxRaw, self)._reading_key(message_id)
+
+    def __getitem__(self, message_id):
+        for listname, index in self.indices.items():
+            if message_id in index:
+                break
+        else:
+            raise KeyError(message_id)
+
+        pack = self.packs.get(listname)
+        if pack is not None:
+            try:
+                return pack[message_id]
+            except KeyError:
+                # Not yet packed
+                pass
+
+        return self._read_raw(index, message_id)
+
 
 class Mbox:
     def __init__(self, config):
         self.threads = None
         self.f_mail_thread_cache = config.f_mail_thread_cache
-        self.lists = dict()
         self.d_mbox = config.d_mbox
         self.d_invalid = os.path.join(self.d_mbox, 'invalid')
         self.d_index = os.path.join(self.d_mbox, 'index')
+        self.f_pending = os.path.join(self.d_index, 'pending')
 
         log.info('Loading mailbox subsystem')
 
         os.makedirs(self.d_invalid, exist_ok=True)
         os.makedirs(self.d_index, exist_ok=True)
 
-        self.invalid = set()
-        for f_inval in glob.glob(os.path.join(self.d_invalid, '*')):
-            self.invalid |= {x[0] for x in load_file(f_inval)}
+        self.invalid = InvalidLog(self.d_invalid)
         log.info('  ↪ loaded invalid mail index: found %d invalid mails'
                  % len(self.invalid))
 
+        # A source is a mailing list of a container. Sources are described by
+        # tuples of (listname, container, f_index, get_hashes), where get_hashes
+        # returns the Message-ID hashes of the source.
+        raw_sources = []
+        pub_sources = []
+
         if len(config.mbox_raw):
             log.info('Loading raw mailboxes...')
         self.mbox_raw = MboxRaw(self.d_mbox, self.d_index)
         for listname, f_mbox_raw in config.mbox_raw:
-            message_ids = self.mbox_raw.add_mbox(listname, f_mbox_raw)
-            for message_id in message_ids:
-                self.add_mail_to_list(message_id, listname)
+            index = self.mbox_raw.add_mbox(listname, f_mbox_raw)
+            raw_sources.append((listname, self.mbox_raw, index.f_bin,
+                                lambda x=index: x.hashes))
 
         self.pub_in = []
         if len(config.mbox_git_public_inbox):
@@ -370,8 +564,9 @@ class Mbox:
 
                     if os.path.isdir(d_repo):
                         inbox = PubInbox(listname, d_repo, f_index)
-                        for message_id in inbox.message_ids():
-                            self.add_mail_to_list(message_id, mailinglist)
+                        pub_sources.append((mailinglist, inbox,
+                                            inbox.index.f_bin,
+                                            lambda x=inbox: x.index.hashes))
                         self.pub_in.append(inbox)
                     else:
                         if shard == 0:
@@ -382,96 +577,151 @@ class Mbox:
 
                     shard += 1
 
+        # Public inboxes take precedence over raw mailboxes
+        self.sources = pub_sources + raw_sources
+        self.router = MessageRouter.load(
+            os.path.join(self.d_index, 'router'),
+            self.get_signature(),
+            [get_hashes for (_, _, _, get_hashes) in self.sources])
+        log.info('  ↪ loaded message router: found %d mails' % len(self.router))
+
+        # Fold the invalid set into the bitmaps of the indices
+        self._invalidate_containers(self.invalid.hashes)
+
+    def _invalidate_containers(self, hashes):
+        for container in self.get_all_containers():
+            container.invalidate(hashes)
+
+    def get_signature(self):
+        signature = []
+        for listname, _, f_index, _ in self.sources:
+            try:
+                stat = os.stat(f_index)
+                stat = stat.st_size, stat.st_mtime_ns
+            except FileNotFoundError:
+                stat = -1, -1
+            signature.append('%s %s %d %d' % ((listname, f_index) + stat))
+        return '\n'.join(signature)
+
+    def get_all_containers(self):
+        return self.pub_in + [self.mbox_raw]
+
+    def get_containers(self, message_id):
+        containers = []
+        for source in self.router.lookup(message_id):
+            container = self.sources[source][1]
+            if container not in containers:
+                containers.append(container)
+        return containers
+
     def load_threads(self):
         if not self.threads:
             self.threads = MailThread.load(self.f_mail_thread_cache, self)
         return self.threads
 
-    def add_mail_to_list(self, message_id, list):
-        if message_id not in self.lists:
-            self.lists[message_id] = set()
-        self.lists[message_id].add(list)
-
     def __contains__(self, message_id):
-        for public_inbox in self.pub_in:
-            if message_id in public_inbox:
-                return True
-
-        if message_id in self.mbox_raw:
-            return True
-
-        return False
+        return len(self.router.lookup(message_id)) != 0
 
     def __getitem__(self, message_id):
-        messages = self.get_messages(message_id)
-        exception = None
-
-        if len(messages) == 0:
-            raise KeyError('Message not found')
+        patch, exception = self.get_patch_mail(message_id)
+        if patch is None:
+            raise exception
+        return patch
+
+    def get_patch_mail(self, message_id, container=None):
+        """
+        Creates the PatchMail of a Message-ID. The copy of container is tried
+        first, further copies of the mail are only read if it fails. Identical
+        copies are parsed only once.
+
+        :return: tuple of (PatchMail, None) or (None, exception)
+        """
+        def raws():
+            if container:
+                try:
+                    yield container[message_id]
+                except KeyError:
+                    pass
+            yield from self.get_raws(message_id)
+
+        exception = KeyError('Message not found')
+        tried = set()
+        for raw in raws():
+            if raw in tried:
+                continue
+            tried.add(raw)
 
-        for message in messages:
             try:
-                patch = PatchMail(message)
-                return patch
+                return PatchMail(email.message_from_bytes(raw)), None
             except Exception as e:
                 exception = e
 
-        raise exception
+        return None, exception
 
     def get_messages(self, message_id):
         raws = self.get_raws(message_id)
 
         return [email.message_from_bytes(raw) for raw in raws]
 
+    def get_headers(self, message_id):
+        # Identical copies of a mail are parsed only once
+        raws = dict.fromkeys(self.get_raws(message_id))
+        return [MailHeaders(raw) for raw in raws]
+
     def get_raws(self, message_id):
         raws = list()
 
-        for public_inbox in self.pub_in:
-            if message_id in public_inbox:
-                raws.append(public_inbox[message_id])
-
-        if message_id in self.mbox_raw:
-            raws.append(self.mbox_raw[message_id])
+        for container in self.get_containers(message_id):
+            # The router is based on hashes. In case of collisions, the
+            # message might not be part of the container.
+            try:
+                raws.append(container[message_id])
+            except KeyError:
+                pass
 
         return raws
 
     def message_ids(self, time_window=None, allow_invalid=False):
         ids = set()
 
-        for pub in self.pub_in:
-            ids |= pub.message_ids(time_window)
-
-        ids |= self.mbox_raw.message_ids(time_window)
-
-        if allow_invalid:
-            return ids
+        for container in self.get_all_containers():
+            ids |= container.message_ids(time_window, allow_invalid)
 
-        return ids - self.invalid
+        return ids
 
     def update(self):
-        self.mbox_raw.update()
+        message_ids = self.mbox_raw.update()
+        message_ids |= update_public_inboxes(self.pub_in)
+        self.add_pending(message_ids)
+
+    def get_pending(self):
+        """
+        Returns the set of mails that were ingested, but not yet processed by
+        the mail thread cache. None, if pending mails are not tracked yet.
+        """
+        if not os.path.isfile(self.f_pending):
+            return None
 
-        for pub in self.pub_in:
-            pub.update()
+        with open(self.f_pending, 'r') as f:
+            return set(f.read().split())
 
-    def get_lists(self, message_id):
-        return self.lists[message_id]
+    def add_pending(self, message_ids):
+        # The thread cache compares against all mails, if there is no list of
+        # pending mails. The list is created once the thread cache is updated.
+        if not os.path.isfile(self.f_pending):
+            return
 
-    def invalidate(self, invalid):
-        self.invalid |= set(invalid)
-
-        # For data persistence, note that we have to split invalid list to
-        # chunks of 1.000.000 entries (~50MiB) to overcome GitHub's maximum
-        # file size.
-        chunksize = 1000000
+        with open(self.f_pending, 'a') as f:
+            f.write(''.join(['%s\n' % x for x in message_ids]))
 
-        invalid = list(self.invalid)
-        invalid.sort()
+    def clear_pending(self):
+        open(self.f_pending, 'w').close()
 
-        invalid = [invalid[x:x+chunksize]
-                   for x in range(0, len(invalid), chunksize)]
+    def get_lists(self, message_id):
+        return {self.sources[source][0]
+                for source in self.router.lookup(message_id)}
 
-        for no, inv in enumerate(invalid):
-            f_invalid = os.path.join(self.d_invalid, '%d' % no)
-            with open(f_invalid, 'w') as f:
-                f.write('\n'.join(inv) + '\n')
+    def invalidate(self, invalid):
+        hashes = self.invalid.add(invalid)
+        if len(hashes):
+            self._invalidate_containers(hashes)
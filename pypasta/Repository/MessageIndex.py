@@ -0,0 +1,556 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2019
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import datetime
+import glob
+import mmap
+import numpy as np
+import os
+import struct
+
+from hashlib import blake2b
+from logging import getLogger
+
+log = getLogger(__name__[-15:])
+
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+
+def message_id_hash(message_id):
+    """
+    Returns a stable 64-bit hash of a Message-ID. In contrast to hash(), the
+    result does not depend on the interpreter instance, and can be persisted.
+    """
+    digest = blake2b(message_id.encode('utf-8', 'surrogateescape'),
+                     digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def day_number(date):
+    """
+    Returns the number of days since epoch of a datetime, date or a date string
+    in the format of the mail indices (YYYY/MM/DD)
+    """
+    if isinstance(date, str):
+        year, month, day = date.split('/')
+        date = datetime.date(int(year), int(month), int(day))
+    elif isinstance(date, datetime.datetime):
+        date = date.date()
+
+    return date.toordinal() - EPOCH
+
+
+def day_range(time_window):
+    """
+    Converts a time window of datetimes to an inclusive range of day numbers.
+    A day is in the window, if its midnight is in the window.
+    """
+    lower, upper = time_window
+    lower_day = day_number(lower)
+    if isinstance(lower, datetime.datetime) and \
+       lower.time() != datetime.time.min:
+        lower_day += 1
+
+    return lower_day, day_number(upper)
+
+
+def sorted_matches(haystack, needles):
+    """
+    Returns the positions of all elements of the sorted array haystack that
+    are in needles. The cost is proportional to the number of needles.
+    """
+    needles = np.asarray(needles, dtype='<u8')
+    left = np.searchsorted(haystack, needles, side='left')
+    right = np.searchsorted(haystack, needles, side='right')
+    lengths = right - left
+
+    # Expand the ranges [left, right) to positions
+    starts = np.repeat(left - np.cumsum(lengths) + lengths, lengths)
+    return starts + np.arange(lengths.sum())
+
+
+def encode_ids(message_ids):
+    """
+    Returns the '\n'-terminated, encoded Message-IDs and their offsets
+    """
+    ids = [(x + '\n').encode('utf-8', 'surrogateescape') for x in message_ids]
+    offsets = np.zeros(len(ids) + 1, dtype='<u8')
+    np.cumsum([len(x) for x in ids], out=offsets[1:])
+    return b''.join(ids), offsets
+
+
+def splice_ids(blob, offsets, positions, message_ids):
+    """
+    Inserts Message-IDs into a blob of '\n'-terminated Message-IDs. The i-th
+    Message-ID is inserted before the row positions[i]. Existing Message-IDs
+    are not decoded.
+
+    :param positions: sorted rows of the blob
+    :return: tuple of the new blob and its offsets
+    """
+    encoded = [(x + '\n').encode('utf-8', 'surrogateescape')
+               for x in message_ids]
+    lengths = np.array([len(x) for x in encoded], dtype='<u8')
+
+    pieces = list()
+    prev = 0
+    for cut, id in zip(offsets[positions].tolist(), encoded):
+        pieces += [blob[prev:cut], id]
+        prev = cut
+    pieces.append(blob[prev:])
+
+    new_offsets = np.zeros(len(offsets) + len(encoded), dtype='<u8')
+    np.cumsum(np.insert(np.diff(offsets), positions, lengths),
+              out=new_offsets[1:])
+
+    return b''.join(pieces), new_offsets
+
+
+def insert_rows(num, positions):
+    """
+    Returns the rows of num existing rows and the rows of the inserted rows
+    after inserting rows before the sorted positions, as of np.insert()
+    """
+    old_rows = np.arange(num) + np.searchsorted(positions, np.arange(num),
+                                                side='right')
+    new_rows = positions + np.arange(len(positions))
+    return old_rows, new_rows
+
+
+class MessageIndex:
+    """
+    Compact, memory-mapped, binary index of a mail container. The index
+    contains the following columns, sorted by the hash of the Message-ID:
+      - 64-bit hashes of Message-IDs
+      - 32-bit day numbers (days since epoch)
+      - fixed-size binary locations (e.g., 20-byte commit OIDs)
+      - offsets of the Message-IDs in the Message-ID blob
+      - rows, sorted by their day number, and the sorted day numbers
+    The latter turn queries for time windows into range slices. The binary
+    index is (re-)created from the textual index, if it is missing or
+    outdated.
+
+    Additionally, the index carries a bitmap of invalid mails. The bitmap is
+    not persisted, it is maintained by the owner of the index.
+    """
+    MAGIC = b'PaStAIX1'
+    HEADER = struct.Struct('<8sQQQ')
+    SUFFIX = '.bin'
+
+    def __init__(self, f_bin):
+        self.f_bin = f_bin
+        with open(f_bin, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.num, self.location_size, ids_len = \
+            MessageIndex.HEADER.unpack_from(self.mm)
+        if magic != MessageIndex.MAGIC:
+            raise ValueError('Invalid message index: %s' % f_bin)
+
+        num = self.num
+        offset = MessageIndex.HEADER.size
+
+        def column(dtype, count):
+            nonlocal offset
+            ret = np.frombuffer(self.mm, dtype=dtype, count=count,
+                                offset=offset)
+            offset += ret.nbytes
+            return ret
+
+        self.hashes = column('<u8', num)
+        self.offsets = column('<u8', num + 1)
+        self.days = column('<i4', num)
+        self.locations = column('u1', num * self.location_size)
+        self.locations = self.locations.reshape(num, self.location_size)
+        self.day_order = column('<u4', num)
+        self.sorted_days = column('<i4', num)
+        self.ids_offset = offset
+        self.ids_len = ids_len
+
+        self.invalid = np.zeros(num, dtype=bool)
+
+    @staticmethod
+    def _columns(entries, location_size):
+        num = len(entries)
+        hashes = np.fromiter((message_id_hash(x[1]) for x in entries),
+                             dtype='<u8', count=num)
+        days = np.fromiter((day_number(x[0]) for x in entries), dtype='<i4',
+                           count=num)
+        locations = b''.join(bytes.fromhex(x[2]) for x in entries)
+        if len(locations) != num * location_size:
+            raise ValueError('Invalid location size')
+        locations = np.frombuffer(locations, dtype='u1')
+        locations = locations.reshape(num, location_size)
+        ids = [x[1] for x in entries]
+
+        return hashes, days, locations, ids
+
+    @staticmethod
+    def _write_columns(f_bin, hashes, days, locations, ids):
+        order = np.argsort(hashes, kind='stable')
+        hashes = hashes[order]
+        days = days[order]
+        locations = locations[order]
+        ids, offsets = encode_ids([ids[row] for row in order.tolist()])
+
+        day_order = np.argsort(days, kind='stable').astype('<u4')
+        sorted_days = days[day_order]
+
+        MessageIndex._write_file(f_bin, hashes, offsets, days, locations,
+                                 day_order, sorted_days, ids)
+
+    @staticmethod
+    def _write_file(f_bin, hashes, offsets, days, locations, day_order,
+                    sorted_days, ids):
+        num, location_size = locations.shape
+
+        os.makedirs(os.path.dirname(f_bin), exist_ok=True)
+        f_tmp = f_bin + '.tmp'
+        with open(f_tmp, 'wb') as f:
+            f.write(MessageIndex.HEADER.pack(MessageIndex.MAGIC, num,
+                                             location_size, len(ids)))
+            f.write(hashes.astype('<u8').tobytes())
+            f.write(offsets.astype('<u8').tobytes())
+            f.write(days.astype('<i4').tobytes())
+            f.write(locations.tobytes())
+            f.write(day_order.astype('<u4').tobytes())
+            f.write(sorted_days.astype('<i4').tobytes())
+            f.write(ids)
+        os.replace(f_tmp, f_bin)
+
+    @staticmethod
+    def write(f_bin, entries, location_size):
+        """
+        Writes a binary index.
+
+        :param entries: list of (date, message_id, location) tuples, where date
+                        is in the format of the textual indices, and location is
+                        a hex string of location_size bytes
+        """
+        MessageIndex._write_columns(f_bin, *MessageIndex._columns(
+            entries, location_size))
+
+    def append(self, entries):
+        """
+        Merges entries into the binary index. Only new entries are hashed and
+        sorted, existing rows are merged with vectorised inserts and are
+        never decoded. Returns the updated index.
+        """
+        hashes, days, locations, ids = \
+            MessageIndex._columns(entries, self.location_size)
+        if not len(hashes):
+            return self
+
+        order = np.argsort(hashes, kind='stable')
+        hashes = hashes[order]
+        days = days[order]
+        locations = locations[order]
+        ids = [ids[row] for row in order.tolist()]
+
+        # Rows of the index before which the new rows are inserted
+        positions = np.searchsorted(self.hashes, hashes, side='right')
+
+        blob = self.mm[self.ids_offset:self.ids_offset + self.ids_len]
+        blob, offsets = splice_ids(blob, self.offsets, positions, ids)
+
+        # Rows of the existing and the new entries in the merged index
+        old_rows, new_rows = insert_rows(self.num, positions)
+
+        # Merge the new rows into the day order
+        day_order = np.argsort(days, kind='stable')
+        new_days = days[day_order]
+        day_positions = np.searchsorted(self.sorted_days, new_days,
+                                        side='right')
+
+        MessageIndex._write_file(
+            self.f_bin,
+            np.insert(self.hashes, positions, hashes),
+            offsets,
+            np.insert(self.days, positions, days),
+            np.insert(self.locations, positions, locations, axis=0),
+            np.insert(old_rows[self.day_order], day_positions,
+                      new_rows[day_order]),
+            np.insert(self.sorted_days, day_positions, new_days),
+            blob)
+
+        return MessageIndex(self.f_bin)
+
+    @staticmethod
+    def load(f_index, location_size, entries=None):
+        """
+        Loads the binary index of the textual index f_index. The binary index
+        is rebuilt, if it is missing, outdated, or if entries are provided.
+        """
+        f_bin = f_index + MessageIndex.SUFFIX
+
+        if entries is None:
+            stale = not os.path.isfile(f_bin) or \
+                    (os.path.isfile(f_index) and
+                     os.path.getmtime(f_index) > os.path.getmtime(f_bin))
+            if not stale:
+                try:
+                    return MessageIndex(f_bin)
+                except ValueError:
+                    # Invalid binary index
+                    pass
+
+            log.info('  ↪ creating binary index for %s' % f_index)
+            entries = []
+            if os.path.isfile(f_index):
+                with open(f_index, 'r') as f:
+                    entries = [tuple(line.split(' ')) for line in
+                               f.read().split('\n') if line]
+
+        MessageIndex.write(f_bin, entries, location_size)
+        return MessageIndex(f_bin)
+
+    def _message_id(self, row):
+        start = self.ids_offset + int(self.offsets[row])
+        end = self.ids_offset + int(self.offsets[row + 1]) - 1
+        return self.mm[start:end].decode('utf-8', 'surrogateescape')
+
+    def find(self, message_id):
+        """
+        Returns the row of message_id, or None if message_id is not indexed
+        """
+        hash = np.uint64(message_id_hash(message_id))
+        row = int(np.searchsorted(self.hashes, hash))
+
+        # Respect hash collisions
+        while row < self.num and self.hashes[row] == hash:
+            if self._message_id(row) == message_id:
+                return row
+            row += 1
+
+        return None
+
+    def get_location(self, message_id):
+        row = self.find(message_id)
+        if row is None:
+            raise KeyError(message_id)
+        return self.locations[row].tobytes().hex()
+
+    def get_date(self, message_id):
+        row = self.find(message_id)
+        if row is None:
+            raise KeyError(message_id)
+        return datetime.date.fromordinal(EPOCH + int(self.days[row]))
+
+    def get_locations(self):
+        data = self.locations.tobytes()
+        size = self.location_size
+        return {data[i:i + size].hex() for i in range(0, len(data), size)}
+
+    def _all_message_ids(self):
+        # Message-IDs are stored in the order of rows
+        ids = self.mm[self.ids_offset:self.ids_offset + self.ids_len]
+        # Message-IDs are '\n'-terminated. In contrast to splitlines(), this
+        # does not split at other line boundaries, like \x0b or \x1c.
+        return ids.decode('utf-8', 'surrogateescape').split('\n')[:-1]
+
+    def invalidate(self, hashes):
+        """
+        Marks all mails with the given Message-ID hashes as invalid
+        """
+        self.invalid[sorted_matches(self.hashes, hashes)] = True
+
+    def message_ids(self, time_window=None, allow_invalid=False):
+        if time_window:
+            lower, upper = day_range(time_window)
+            start = np.searchsorted(self.sorted_days, lower, side='left')
+            end = np.searchsorted(self.sorted_days, upper, side='right')
+            rows = self.day_order[start:end]
+        elif allow_invalid or not self.invalid.any():
+            return set(self._all_message_ids())
+        else:
+            rows = np.arange(self.num)
+
+        if not allow_invalid:
+            rows = rows[~self.invalid[rows]]
+
+        # Decoding all Message-IDs at once is cheaper for large windows
+        if 4 * len(rows) > self.num:
+            ids = self._all_message_ids()
+            return {ids[row] for row in rows.tolist()}
+
+        return {self._message_id(row) for row in rows.tolist()}
+
+    def __contains__(self, message_id):
+        return self.find(message_id) is not None
+
+    def __len__(self):
+        return self.num
+
+
+def message_id_hashes(message_ids):
+    return np.fromiter((message_id_hash(x) for x in message_ids),
+                       dtype='<u8', count=len(message_ids))
+
+
+class InvalidLog:
+    """
+    Persistent set of invalid mails. Invalid mails are stored as 64-bit
+    hashes of their Message-IDs in an append-only log (<d_invalid>/log), so
+    the cost of invalidation is proportional to the number of newly invalid
+    mails. In memory, the set is a sorted array of hashes.
+
+    Former textual chunks of Message-IDs in d_invalid are migrated once.
+    """
+    def __init__(self, d_invalid):
+        self.f_log = os.path.join(d_invalid, 'log')
+        if not os.path.isfile(self.f_log):
+            self._migrate(d_invalid)
+
+        self.hashes = np.unique(np.fromfile(self.f_log, dtype='<u8'))
+
+    def _migrate(self, d_invalid):
+        message_ids = set()
+        # Former chunks are enumerated: 0, 1, ...
+        for f_inval in glob.glob(os.path.join(d_invalid, '[0-9]*')):
+            with open(f_inval, 'r') as f:
+                message_ids |= set(f.read().split())
+
+        if message_ids:
+            log.info('  ↪ migrating %d invalid mails to %s' %
+                     (len(message_ids), self.f_log))
+
+        hashes = np.unique(message_id_hashes(list(message_ids)))
+        f_tmp = self.f_log + '.tmp'
+        hashes.tofile(f_tmp)
+        os.replace(f_tmp, self.f_log)
+
+    def add(self, message_ids):
+        """
+        Adds Message-IDs to the set. Returns the hashes of the Message-IDs
+        that were not yet invalid.
+        """
+        hashes = np.unique(message_id_hashes(list(message_ids)))
+        known = sorted_matches(self.hashes, hashes)
+        new = np.setdiff1d(hashes, self.hashes[known], assume_unique=True)
+        if not len(new):
+            return new
+
+        with open(self.f_log, 'ab') as f:
+            new.tofile(f)
+
+        self.hashes = np.insert(self.hashes,
+                                np.searchsorted(self.hashes, new), new)
+        return new
+
+    def __contains__(self, message_id):
+        hash = message_id_hash(message_id)
+        pos = np.searchsorted(self.hashes, hash)
+        return pos < len(self.hashes) and self.hashes[pos] == hash
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+class MessageRouter:
+    """
+    Unified, persistent index that routes Message-IDs to the sources (e.g.,
+    mailing lists or shards of public inboxes) that contain them. For each
+    hash of a Message-ID, it stores the (sorted) list of source ids, so a
+    lookup is a single probe, even if a message appears on several lists.
+
+    The router is validated with a signature of its sources, and rebuilt if
+    the signature doesn't match.
+    """
+    MAGIC = b'PaStART1'
+    HEADER = struct.Struct('<8sQQQ')
+
+    def __init__(self, f_router):
+        self.f_router = f_router
+        with open(f_router, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.num, num_sources, signature_len = \
+            MessageRouter.HEADER.unpack_from(self.mm)
+        if magic != MessageRouter.MAGIC:
+            raise ValueError('Invalid message router: %s' % f_router)
+
+        offset = MessageRouter.HEADER.size
+        self.hashes = np.frombuffer(self.mm, dtype='<u8', count=self.num,
+                                    offset=offset)
+        offset += self.hashes.nbytes
+        self.offsets = np.frombuffer(self.mm, dtype='<u8', count=self.num + 1,
+                                     offset=offset)
+        offset += self.offsets.nbytes
+        self.sources = np.frombuffer(self.mm, dtype='<u2', count=num_sources,
+                                     offset=offset)
+        offset += self.sources.nbytes
+        self.signature = self.mm[offset:offset + signature_len].decode()
+
+    @staticmethod
+    def write(f_router, signature, hashes):
+        """
+        Writes a router.
+
+        :param signature: signature string of the sources
+        :param hashes: list of arrays of Message-ID hashes, one per source
+        """
+        source_ids = [np.full(len(x), id, dtype='<u2')
+                      for id, x in enumerate(hashes)]
+        hashes = np.concatenate([np.empty(0, dtype='<u8')] + hashes)
+        source_ids = np.concatenate([np.empty(0, dtype='<u2')] + source_ids)
+
+        order = np.lexsort((source_ids, hashes))
+        hashes = hashes[order]
+        source_ids = source_ids[order]
+
+        hashes, first = np.unique(hashes, return_index=True)
+        offsets = np.append(first, len(source_ids)).astype('<u8')
+
+        signature = signature.encode()
+
+        os.makedirs(os.path.dirname(f_router), exist_ok=True)
+        f_tmp = f_router + '.tmp'
+        with open(f_tmp, 'wb') as f:
+            f.write(MessageRouter.HEADER.pack(MessageRouter.MAGIC, len(hashes),
+                                              len(source_ids), len(signature)))
+            f.write(hashes.astype('<u8').tobytes())
+            f.write(offsets.tobytes())
+            f.write(source_ids.tobytes())
+            f.write(signature)
+        os.replace(f_tmp, f_router)
+
+    @staticmethod
+    def load(f_router, signature, get_hashes):
+        """
+        Loads the router, and rebuilds it if its signature is outdated.
+
+        :param get_hashes: list of callables, one per source, that return the
+                           Message-ID hashes of the source
+        """
+        if os.path.isfile(f_router):
+            router = MessageRouter(f_router)
+            if router.signature == signature:
+                return router
+            del router
+
+        log.info('  ↪ creating message router')
+        MessageRouter.write(f_router, signature, [x() for x in get_hashes])
+        return MessageRouter(f_router)
+
+    def lookup(self, message_id):
+        """
+        Returns the ids of all sources that contain message_id
+        """
+        hash = np.uint64(message_id_hash(message_id))
+        row = int(np.searchsorted(self.hashes, hash))
+        if row == self.num or self.hashes[row] != hash:
+            return []
+
+        return self.sources[self.offsets[row]:self.offsets[row + 1]].tolist()
+
+    def __len__(self):
+        return self.num
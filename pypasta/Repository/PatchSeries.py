@@ -0,0 +1,237 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2019
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import mmap
+import numpy as np
+import os
+import re
+import struct
+
+from logging import getLogger
+
+log = getLogger(__name__[-15:])
+
+REPLY_REGEX = re.compile(r'^\s*(re|aw|fwd?)\s*:', re.IGNORECASE)
+PATCH_TAG_REGEX = re.compile(r'\[([^\]]*\bPATCH\b[^\]]*)\]', re.IGNORECASE)
+VERSION_REGEX = re.compile(r'\bv(\d+)\b', re.IGNORECASE)
+NUMBER_REGEX = re.compile(r'\b(\d+)/(\d+)\b')
+
+
+def parse_subject(subject):
+    """
+    Parses the [PATCH vN m/n] prefix of a subject.
+
+    :return: tuple of (version, number, total), or None if the subject is not
+             the subject of a patch
+    """
+    if not subject or REPLY_REGEX.match(subject):
+        return None
+
+    match = PATCH_TAG_REGEX.search(subject)
+    if not match:
+        return None
+    tag = match.group(1)
+
+    version = 1
+    match = VERSION_REGEX.search(tag)
+    if match:
+        version = int(match.group(1))
+
+    number, total = 1, 1
+    match = NUMBER_REGEX.search(tag)
+    if match:
+        number, total = int(match.group(1)), int(match.group(2))
+
+    return version, number, total
+
+
+class SeriesIndex:
+    """
+    Index of patch series. Patches are grouped to series by the root of
+    their thread, their author, their version and the total number of
+    patches of the series, as given by the [PATCH vN m/n] prefix of their
+    subject. The cover letter of a series is its 0/n mail.
+
+    The index is built from the columns of the mail metadata table, and rows
+    refer to rows of the table. It is mmapped at load.
+    """
+    MAGIC = b'PaStASI1'
+    HEADER = struct.Struct('<8sQQ')
+    SUFFIX = '.series.idx'
+
+    def __init__(self, f_index, metadata):
+        self.f_index = f_index
+        self.metadata = metadata
+        with open(f_index, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.num, self.num_series = \
+            SeriesIndex.HEADER.unpack_from(self.mm)
+        if magic != SeriesIndex.MAGIC:
+            raise ValueError('Invalid series index: %s' % f_index)
+
+        num = self.num
+        num_series = self.num_series
+        offset = SeriesIndex.HEADER.size
+
+        def column(dtype, count):
+            nonlocal offset
+            ret = np.frombuffer(self.mm, dtype=dtype, count=count,
+                                offset=offset)
+            offset += ret.nbytes
+            return ret
+
+        # Rows of the metadata table, ascending
+        self.rows = column('<i4', num)
+        self.series = column('<i4', num)
+        self.numbers = column('<i4', num)
+        self.member_offsets = column('<u4', num_series + 1)
+        self.members = column('<i4', num)
+        self.covers = column('<i4', num_series)
+        self.versions = column('<i4', num_series)
+        self.totals = column('<i4', num_series)
+
+    @staticmethod
+    def load(f_index, metadata):
+        if not metadata or not os.path.isfile(f_index):
+            return None
+
+        try:
+            return SeriesIndex(f_index, metadata)
+        except ValueError:
+            log.warning('  ↪ series index %s is invalid' % f_index)
+            return None
+
+    @staticmethod
+    def write(f_index, metadata):
+        """
+        Builds the series index from the columns of the metadata table
+        """
+        rows = np.flatnonzero(metadata.numbers >= 0).astype('<i4')
+        num = len(rows)
+
+        # Authors are identified by their address, if available. Negative
+        # ids refer to names.
+        authors = metadata.emails[rows].astype(np.int64)
+        emails = metadata.get_emails()
+        if '' in emails:
+            no_address = authors == emails.index('')
+            authors[no_address] = -1 - metadata.names[rows][no_address]
+
+        roots = metadata.roots[rows].astype(np.int64)
+        roots = np.where(roots == -1, rows, roots)
+        versions = metadata.versions[rows].astype(np.int64)
+        totals = metadata.totals[rows].astype(np.int64)
+        numbers = metadata.numbers[rows].astype('<i4')
+
+        # Single patches are series on their own
+        single = totals <= 1
+        keys = np.stack((np.where(single, rows, roots),
+                         np.where(single, 0, authors),
+                         np.where(single, 0, versions),
+                         np.where(single, -1, totals)), axis=1)
+
+        if num:
+            keys, series = np.unique(keys, axis=0, return_inverse=True)
+            series = series.reshape(-1).astype('<i4')
+        else:
+            keys = np.zeros((0, 4), dtype=np.int64)
+            series = np.zeros(0, dtype='<i4')
+        num_series = len(keys)
+
+        members = np.lexsort((numbers, series)).astype('<i4')
+        member_offsets = np.zeros(num_series + 1, dtype='<u4')
+        np.cumsum(np.bincount(series, minlength=num_series),
+                  out=member_offsets[1:])
+
+        covers = np.full(num_series, -1, dtype='<i4')
+        is_cover = numbers == 0
+        covers[series[is_cover]] = np.flatnonzero(is_cover)
+
+        first = members[member_offsets[:-1]]
+        versions = versions[first].astype('<i4')
+        totals = totals[first].astype('<i4')
+
+        f_tmp = f_index + '.tmp'
+        with open(f_tmp, 'wb') as f:
+            f.write(SeriesIndex.HEADER.pack(SeriesIndex.MAGIC, num,
+                                            num_series))
+            f.write(rows.tobytes())
+            f.write(series.tobytes())
+            f.write(numbers.tobytes())
+            f.write(member_offsets.tobytes())
+            f.write(members.tobytes())
+            f.write(covers.tobytes())
+            f.write(versions.tobytes())
+            f.write(totals.tobytes())
+        os.replace(f_tmp, f_index)
+
+        return SeriesIndex(f_index, metadata)
+
+    def message_id(self, row):
+        return self.metadata.message_id(int(self.rows[row]))
+
+    def find(self, message_id):
+        """
+        Returns the row of message_id, or None if it is not part of a series
+        """
+        meta_row = self.metadata.find(message_id)
+        if meta_row is None:
+            return None
+
+        row = int(np.searchsorted(self.rows, meta_row))
+        if row < self.num and self.rows[row] == meta_row:
+            return row
+        return None
+
+    def get_series(self, message_id):
+        """
+        Returns the Message-IDs of all mails of the series of message_id,
+        ordered by their number, including the cover letter
+        """
+        row = self.find(message_id)
+        if row is None:
+            return []
+
+        series = self.series[row]
+        members = self.members[self.member_offsets[series]:
+                               self.member_offsets[series + 1]]
+        return [self.message_id(member) for member in members.tolist()]
+
+    def get_cover_letter(self, message_id):
+        row = self.find(message_id)
+        if row is None:
+            return None
+
+        cover = int(self.covers[self.series[row]])
+        if cover == -1:
+            return None
+        return self.message_id(cover)
+
+    def get_version(self, message_id):
+        row = self.find(message_id)
+        if row is None:
+            return None
+        return int(self.versions[self.series[row]])
+
+    def is_series(self, message_id):
+        """
+        Returns True, if message_id is part of a series of several patches
+        """
+        row = self.find(message_id)
+        return row is not None and self.totals[self.series[row]] > 1
+
+    def __contains__(self, message_id):
+        return self.find(message_id) is not None
+
+    def __len__(self):
+        return self.num_series
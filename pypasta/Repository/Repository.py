@@ -20,6 +20,7 @@ from logging import getLogger
 from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
 
+from .MailCache import build_patch_mails
 from .MessageDiff import MessageDiff, Signature
 from .Mbox import Mbox
 from ..Util import fix_encoding, get_commit_hash_range
@@ -167,18 +168,29 @@ class Repository:
 
         log.info('Caching %d/%d commits' % (len(worklist), len(identifiers)))
 
-        if parallelise:
+        # Mails are cached by a dedicated builder
+        mails = set()
+        if self.mbox:
+            mails = {x for x in worklist if x[0] == '<'}
+            worklist -= mails
+
+        result = list()
+        if mails:
+            result += build_patch_mails(self.mbox, mails, num_cpus,
+                                        parallelise)
+
+        if worklist and parallelise:
             global _tmp_repo
             _tmp_repo = self
 
             with Pool(num_cpus, maxtasksperchild=100) as p:
-                result = list(tqdm(p.imap(_load_commit_subst, worklist,
-                                          chunksize=1000),
-                                   total=len(worklist)))
+                result += tqdm(p.imap(_load_commit_subst, worklist,
+                                      chunksize=1000),
+                               total=len(worklist))
 
             _tmp_repo = None
-        else:
-            result = list(map(lambda x: (x, self._load_commit(x)), worklist))
+        elif worklist:
+            result += map(lambda x: (x, self._load_commit(x)), worklist)
 
         invalid = {key for (key, value) in result if value is None}
         result = {key: value for (key, value) in result if value is not None}
@@ -0,0 +1,125 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2019
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import numpy as np
+
+from logging import getLogger
+
+log = getLogger(__name__[-15:])
+
+COLUMNS = ['message_id', 'author', 'date', 'lists', 'responses',
+           'foreign_responses', 'reviewers', 'first_response', 'depth']
+
+
+def _metadata_rows(index, metadata):
+    """
+    Returns the row of the metadata table of each row of the thread index, or
+    -1 if the mail is not part of the table. Both are sorted by the hash of
+    the Message-ID.
+    """
+    hashes = index.hashes
+    pos = np.searchsorted(metadata.hashes, hashes)
+    valid = pos < len(metadata)
+    valid[valid] = metadata.hashes[pos[valid]] == hashes[valid]
+    rows = np.where(valid, pos, -1).astype(np.int64)
+
+    # Respect hash collisions
+    duplicates = np.flatnonzero(hashes[1:] == hashes[:-1])
+    for row in set(duplicates.tolist()) | set((duplicates + 1).tolist()):
+        meta_row = metadata.find(index.message_id(row))
+        rows[row] = -1 if meta_row is None else meta_row
+
+    return rows
+
+
+def response_statistics(index, metadata, message_ids):
+    """
+    Computes response statistics of mails (e.g., patches) in a single pass
+    over the thread index. For each mail, responses are all mails in its
+    subtree. Foreign responses are responses of other authors, authors are
+    identified by their address. Mails of unknown authors are ignored.
+
+    :return: dict of columns (see COLUMNS). first_response is the latency of
+             the first foreign response in seconds, NaN if there is none.
+             depth is the maximum depth of responses below the mail.
+    """
+    order, depths, starts, ends = index.preorder()
+
+    # Authors and dates in pre-order
+    meta_rows = _metadata_rows(index, metadata)
+    known = meta_rows != -1
+    emails = metadata.get_emails()
+    authors = np.full(index.num, -1, dtype=np.int64)
+    authors[known] = metadata.emails[meta_rows[known]]
+    if '' in emails:
+        authors[authors == emails.index('')] = -1
+    dates = np.zeros(index.num, dtype=np.int64)
+    dates[known] = metadata.dates[meta_rows[known]]
+
+    authors = authors[order]
+    dates = dates[order]
+    depths = depths[order]
+
+    columns = {column: list() for column in COLUMNS}
+    missing = 0
+    for message_id in message_ids:
+        row = index.find(message_id)
+        if row is None or not known[row]:
+            missing += 1
+            continue
+
+        start, end = int(starts[row]), int(ends[row])
+        author = authors[start]
+        meta_row = meta_rows[row]
+
+        responses = authors[start + 1:end]
+        foreign = (responses != -1) & (responses != author)
+        first_response = np.nan
+        if foreign.any():
+            first_response = dates[start + 1:end][foreign].min() - \
+                             dates[start]
+        depth = 0
+        if end - start > 1:
+            depth = depths[start + 1:end].max() - depths[start]
+
+        columns['message_id'].append(message_id)
+        columns['author'].append(emails[authors[start]]
+                                 if author != -1 else '')
+        columns['date'].append(dates[start])
+        columns['lists'].append(','.join(metadata.get_lists_of_row(meta_row)))
+        columns['responses'].append(end - start - 1)
+        columns['foreign_responses'].append(int(foreign.sum()))
+        columns['reviewers'].append(len(np.unique(responses[foreign])))
+        columns['first_response'].append(first_response)
+        columns['depth'].append(depth)
+
+    if missing:
+        log.warning('  ↪ %d mails are not part of the thread index or the '
+                    'metadata table' % missing)
+
+    return columns
+
+
+def write_columns(filename, columns):
+    """
+    Writes columns as TSV table with header, to be read by R's read.table.
+    Missing values (NaN) are written as NA.
+    """
+    def format(value):
+        if isinstance(value, float) and np.isnan(value):
+            return 'NA'
+        return str(value)
+
+    with open(filename, 'w') as f:
+        f.write('\t'.join(columns.keys()) + '\n')
+        for row in zip(*columns.values()):
+            f.write('\t'.join([format(value) for value in row]) + '\n')
@@ -0,0 +1,310 @@
+"""
+PaStA - Patch Stack Analysis
+
+Copyright (c) OTH Regensburg, 2019
+
+Author:
+  Ralf Ramsauer <ralf.ramsauer@oth-regensburg.de>
+
+This work is licensed under the terms of the GNU GPL, version 2.  See
+the COPYING file in the top-level directory.
+"""
+
+import mmap
+import numpy as np
+import os
+import struct
+
+from logging import getLogger
+
+from .MessageIndex import encode_ids, insert_rows, message_id_hash, \
+    message_id_hashes, splice_ids
+
+log = getLogger(__name__[-15:])
+
+
+class ThreadIndex:
+    """
+    Compact, memory-mapped index of the thread graph of all mails. Rows are
+    sorted by the hash of the Message-ID. For each row, the index contains
+      - the row of the parent mail (-1 for roots of threads)
+      - the row of the root of the thread
+      - the children of the mail, as offsets into a children array
+    Cycles in the graph are broken when the index is written, so walks on
+    the index always terminate.
+    """
+    MAGIC = b'PaStATI1'
+    HEADER = struct.Struct('<8sQQ')
+    SUFFIX = '.idx'
+
+    def __init__(self, f_index):
+        self.f_index = f_index
+        with open(f_index, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.num, self.ids_len = \
+            ThreadIndex.HEADER.unpack_from(self.mm)
+        if magic != ThreadIndex.MAGIC:
+            raise ValueError('Invalid thread index: %s' % f_index)
+
+        num = self.num
+        offset = ThreadIndex.HEADER.size
+
+        def column(dtype, count):
+            nonlocal offset
+            ret = np.frombuffer(self.mm, dtype=dtype, count=count,
+                                offset=offset)
+            offset += ret.nbytes
+            return ret
+
+        self.hashes = column('<u8', num)
+        self.offsets = column('<u8', num + 1)
+        self.parents = column('<i4', num)
+        self.roots = column('<i4', num)
+        self.child_offsets = column('<u4', num + 1)
+        self.children = column('<i4', int(self.child_offsets[-1]))
+        self.ids_offset = offset
+
+    @staticmethod
+    def load(f_index):
+        if not os.path.isfile(f_index):
+            return None
+
+        try:
+            return ThreadIndex(f_index)
+        except ValueError:
+            log.warning('  ↪ thread index %s is invalid' % f_index)
+            return None
+
+    @staticmethod
+    def _break_cycles(parents, roots=None, rows=None):
+        """
+        Determines the root of each row. If a walk towards the root runs into
+        a cycle, the cycle is broken by turning the row into a root.
+
+        :param roots: known roots, -2 for unknown ones
+        :param rows: rows with unknown roots, all rows if not specified
+        """
+        num = len(parents)
+        if roots is None:
+            roots = np.full(num, -2, dtype='<i4')
+        if rows is None:
+            rows = range(num)
+
+        for row in rows:
+            path = list()
+            on_path = set()
+            cur = row
+            while cur != -1 and roots[cur] == -2 and cur not in on_path:
+                path.append(cur)
+                on_path.add(cur)
+                cur = parents[cur]
+
+            if not path:
+                continue
+            if cur == -1:
+                root = path[-1]
+            elif roots[cur] != -2:
+                root = roots[cur]
+            else:
+                # cur closes a cycle
+                parents[cur] = -1
+                root = cur
+
+            roots[path] = root
+
+        return roots
+
+    @staticmethod
+    def _write_file(f_index, hashes, offsets, blob, parent_rows, roots):
+        num = len(hashes)
+
+        # Children in CSR format, grouped by the row of their parent
+        replies = np.flatnonzero(parent_rows != -1).astype('<i4')
+        children = replies[np.argsort(parent_rows[replies], kind='stable')]
+        child_offsets = np.zeros(num + 1, dtype='<u4')
+        np.cumsum(np.bincount(parent_rows[replies], minlength=num),
+                  out=child_offsets[1:])
+
+        f_tmp = f_index + '.tmp'
+        with open(f_tmp, 'wb') as f:
+            f.write(ThreadIndex.HEADER.pack(ThreadIndex.MAGIC, num,
+                                            len(blob)))
+            f.write(hashes.astype('<u8').tobytes())
+            f.write(offsets.astype('<u8').tobytes())
+            f.write(parent_rows.astype('<i4').tobytes())
+            f.write(roots.astype('<i4').tobytes())
+            f.write(child_offsets.tobytes())
+            f.write(children.astype('<i4').tobytes())
+            f.write(blob)
+        os.replace(f_tmp, f_index)
+
+        return ThreadIndex(f_index)
+
+    @staticmethod
+    def write(f_index, parents):
+        """
+        Writes the thread index.
+
+        :param parents: dict of Message-ID -> Message-ID of the parent, or
+                        None for roots of threads
+        """
+        ids = list(parents.keys())
+        hashes = message_id_hashes(ids)
+        order = np.argsort(hashes, kind='stable')
+        hashes = hashes[order]
+        ids = [ids[row] for row in order.tolist()]
+        rows = {message_id: row for row, message_id in enumerate(ids)}
+
+        parent_rows = np.fromiter(
+            (rows.get(parents[message_id], -1) for message_id in ids),
+            dtype='<i4', count=len(ids))
+        roots = ThreadIndex._break_cycles(parent_rows)
+
+        blob, offsets = encode_ids(ids)
+        return ThreadIndex._write_file(f_index, hashes, offsets, blob,
+                                       parent_rows, roots)
+
+    def merge(self, parents, reparent):
+        """
+        Merges new mails into the index. Existing rows are not decoded, only
+        the threads of new and re-parented mails are walked.
+
+        :param parents: dict of new Message-IDs -> Message-ID of the parent,
+                        or None for roots of threads
+        :param reparent: dict of indexed Message-IDs -> Message-ID of their
+                         new parent
+        :return: the merged index
+        """
+        ids = sorted(parents.keys(), key=message_id_hash)
+        hashes = message_id_hashes(ids)
+
+        # Rows of the index before which the new rows are inserted
+        positions = np.searchsorted(self.hashes, hashes, side='right')
+        old_rows, new_rows = insert_rows(self.num, positions)
+        num = self.num + len(ids)
+
+        new = dict(zip(ids, new_rows.tolist()))
+
+        def merged_row(message_id):
+            if message_id is None:
+                return -1
+            if message_id in new:
+                return new[message_id]
+            row = self.find(message_id)
+            return -1 if row is None else int(old_rows[row])
+
+        blob = self.mm[self.ids_offset:self.ids_offset + self.ids_len]
+        blob, offsets = splice_ids(blob, self.offsets, positions, ids)
+
+        parent_rows = np.insert(
+            np.where(self.parents == -1, -1, old_rows[self.parents]),
+            positions, [merged_row(parents[x]) for x in ids]).astype('<i4')
+        roots = np.insert(old_rows[self.roots], positions, -2).astype('<i4')
+
+        dirty = list(new_rows.tolist())
+        for message_id, parent in reparent.items():
+            row = merged_row(message_id)
+            parent_rows[row] = merged_row(parent)
+            dirty.append(row)
+
+        # Roots of the subtrees of new and re-parented mails are unknown
+        replies = np.flatnonzero(parent_rows != -1)
+        children = replies[np.argsort(parent_rows[replies], kind='stable')]
+        child_offsets = np.zeros(num + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parent_rows[replies], minlength=num),
+                  out=child_offsets[1:])
+
+        unknown = set()
+        stack = list(dirty)
+        while stack:
+            row = stack.pop()
+            if row in unknown:
+                continue
+            unknown.add(row)
+            stack += children[child_offsets[row]:
+                              child_offsets[row + 1]].tolist()
+        unknown = sorted(unknown)
+        roots[unknown] = -2
+        ThreadIndex._break_cycles(parent_rows, roots, unknown)
+
+        return ThreadIndex._write_file(
+            self.f_index, np.insert(self.hashes, positions, hashes), offsets,
+            blob, parent_rows, roots)
+
+    def message_id(self, row):
+        start = self.ids_offset + int(self.offsets[row])
+        end = self.ids_offset + int(self.offsets[row + 1]) - 1
+        return self.mm[start:end].decode('utf-8', 'surrogateescape')
+
+    def find(self, message_id):
+        """
+        Returns the row of message_id, or None if it is not indexed
+        """
+        hash = np.uint64(message_id_hash(message_id))
+        row = int(np.searchsorted(self.hashes, hash))
+
+        # Respect hash collisions
+        while row < self.num and self.hashes[row] == hash:
+            if self.message_id(row) == message_id:
+                return row
+            row += 1
+
+        return None
+
+    def get_children(self, row):
+        return self.children[self.child_offsets[row]:
+                             self.child_offsets[row + 1]].tolist()
+
+    def preorder(self):
+        """
+        Walks all threads of the index once in pre-order. The subtree of a
+        row is the contiguous range [start, end) of the pre-order.
+
+        :return: tuple of arrays (order, depths, starts, ends): the rows in
+                 pre-order, and the depth, start and end of each row
+        """
+        num = self.num
+        order = np.empty(num, dtype='<i4')
+        depths = np.zeros(num, dtype='<i4')
+        starts = np.empty(num, dtype='<i4')
+        ends = np.empty(num, dtype='<i4')
+
+        pos = 0
+        for root in np.flatnonzero(self.parents == -1).tolist():
+            # Negative entries mark the end of the subtree of ~entry
+            stack = [root]
+            while stack:
+                row = stack.pop()
+                if row < 0:
+                    ends[~row] = pos
+                    continue
+
+                starts[row] = pos
+                order[pos] = row
+                pos += 1
+
+                children = self.get_children(row)
+                depths[children] = depths[row] + 1
+                stack.append(~row)
+                stack += reversed(children)
+
+        return order, depths, starts, ends
+
+    def get_root(self, message_id):
+        row = self.find(message_id)
+        if row is None:
+            return None
+        return self.message_id(int(self.roots[row]))
+
+    def get_parent(self, message_id):
+        row = self.find(message_id)
+        if row is None or self.parents[row] == -1:
+            return None
+        return self.message_id(int(self.parents[row]))
+
+    def __contains__(self, message_id):
+        return self.find(message_id) is not None
+
+    def __len__(self):
+        return self.num
@@ -43,7 +43,6 @@ def zarange(start, stop, step):
 	return np.append(np.arange(start, stop, step), 0)
 
 workers_rate = int(cpu_count())
-workers_compare = int(cpu_count())
 
 range_tf = np.arange(1.0, 0.59, -0.05)
 range_th = np.arange(1.0, 0.1, -0.05)
@@ -191,24 +190,5 @@ def worker_rate(q):
 
 #### Compare_eqclasses phase begins here ####
 
-def worker_compare(q):
-	while True:
-		item = q.get()
-		if item is None:
-			break
-		tf, th, ta, dlr, w = item
-
-		result_dir, filename = pg_filename(tf, th, ta, dlr, w)
-		result_destination = result_dir + filename
-		comp_destination = result_destination + '.comp'
-
-		if os.path.isfile(comp_destination):
-			print('%s already exists. Skipping...' % comp_destination)
-			q.task_done()
-			continue
-
-		call(['./pasta', 'compare_eqclasses', '-ar', '-mi', '-nmi', '-pur', '-fm', '-f', comp_destination, ground_truth, result_destination])
-
-		q.task_done()
-
-parallelise(workers_compare, worker_compare)
+call(['./pasta', 'compare_clusters', '-batch', '-f', path + 'comparison.csv',
+      ground_truth, path + 'RES/tf-*/th-*/ta-*/dlr-*/w-?.???'])